@@ -1,13 +1,14 @@
 import os
 import string
-import pexpect
 
 import gtk
 import zipfile
 
 from imagefile import ImageFile, Size
 from cache import cached
-from system import execute
+from metacache import persistent
+from system import execute, stream
+from threads import Lane
 
 class ArchiveFile(ImageFile):
     description = "archive"
@@ -17,6 +18,11 @@ class ArchiveFile(ImageFile):
 
     valid_extensions = (zip_extensions + 
                         rar_extensions)
+    # The listings are obtained with unzip/unrar:
+    lane = Lane.IO
+
+    # The preview is just an icon:
+    persistent_thumbnails = False
 
     def __init__(self, filename):
         ImageFile.__init__(self, filename)
@@ -57,6 +63,7 @@ class ZIPFile:
         self.filename = filename
 
     @cached()
+    @persistent
     def get_metadata(self):
         ret = [("Filename", "Size", "Date", "Time")]
         output = execute(["unzip", "-l", self.filename], check_retcode=False)
@@ -71,15 +78,14 @@ class ZIPFile:
 
     def extract_contents(self, tmp_dir):
         try:
-            child = pexpect.spawn("unzip", [self.filename, "-d", tmp_dir])
-            while True:
-                try:
-                    child.expect("inflating")
-                except pexpect.TIMEOUT:
-                    pass
-                yield None
-        except pexpect.EOF:
-            pass
+            total = max(1, len(self.get_metadata()) - 1)
+            extracted = 0
+            # (unzip only writes line by line to a terminal)
+            for line in stream(["unzip", self.filename, "-d", tmp_dir],
+                               use_pty=True):
+                if "inflating" in line or "extracting" in line:
+                    extracted += 1
+                yield min(1.0, float(extracted) / total)
         except Exception, e:
             print "Warning:", e
 
@@ -88,6 +94,7 @@ class RARFile:
         self.filename = filename
 
     @cached()
+    @persistent
     def get_metadata(self):
         ret = [("Filename", "Original Size", "Packed Size", "Ratio", "Date", "Time", "Attr")]
         output = execute(["unrar", "l", "-c-", self.filename], check_retcode=False)
@@ -107,22 +114,16 @@ class RARFile:
         return ret
 
     def extract_contents(self, tmp_dir):
-        cwd = os.getcwd()
-        os.chdir(tmp_dir)
         try:
-            child = pexpect.spawn("unrar", ["x", self.filename])
-            while True:
-                try:
-                    child.expect("Extracting")
-                except pexpect.TIMEOUT:
-                    pass
-                yield None
-        except pexpect.EOF:
-            pass
+            total = max(1, len(self.get_metadata()) - 1)
+            extracted = 0
+            for line in stream(["unrar", "x", os.path.abspath(self.filename)],
+                               cwd=tmp_dir, use_pty=True):
+                if line.startswith("Extracting  "): # (not "Extracting from")
+                    extracted += 1
+                yield min(1.0, float(extracted) / total)
         except Exception, e:
             print "Warning:", e
-        finally:
-            os.chdir(cwd)
 
 class ArchiveGenerator:
     def generate(self, files, output):
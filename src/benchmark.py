@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+# Replays cache access traces to compare the hit rates of the eviction
+# policies. Traces can be recorded with 'viewer --cache-trace FILE' (one
+# "key size" line per access), or generated with --synthetic, which
+# simulates browsing a directory and sweeping it in the gallery.
+# With --threads, the throughput of the cache accessed by several
+# threads is measured instead.
+import sys
+import time
+import random
+
+from threading import Thread
+from optparse import OptionParser
+
+from cache import Cache
+
+MB = 1024 * 1024
+
+def read_trace(path):
+    trace = []
+    with open(path) as trace_file:
+        for line in trace_file:
+            key, size = line.split()
+            trace.append((int(key), int(size)))
+    return trace
+
+def synthetic_trace(files=2000, seed=0):
+    random.seed(seed)
+    trace = []
+    sizes = [random.randint(4, 48) * MB for i in range(files)]
+
+    def view(index):
+        # Decoded image, rendered image and neighbour thumbnails:
+        trace.append((("pixbuf", index), sizes[index]))
+        trace.append((("render", index), sizes[index] / 4))
+        for neighbour in index - 1, index + 1:
+            if 0 <= neighbour < files:
+                trace.append((("thumbnail", neighbour), 64 * 1024))
+
+    def browse(start, steps):
+        index = start
+        for i in range(steps):
+            # Back and forth around the current image, comparing images
+            # and going back to the ones already seen:
+            index += random.choice([1, 1, -1, -1, -2, 2, 0])
+            index = min(max(index, 0), files - 1)
+            view(index)
+        return index
+
+    def sweep(index):
+        # The gallery loads the thumbnail (and to build it, the decoded
+        # image) of every file once, while the user keeps browsing:
+        for sweep_index in range(files):
+            trace.append((("thumbnail", sweep_index), 64 * 1024))
+            trace.append((("pixbuf", sweep_index), sizes[sweep_index]))
+            if sweep_index % 20 == 0:
+                index = browse(index, 1)
+        return index
+
+    index = browse(files / 2, 500)
+    index = sweep(index)
+    browse(index, 500)
+    return [(hash(key), size) for key, size in trace]
+
+def replay(trace, policy, max_bytes):
+    cache = Cache(max_bytes=max_bytes, sizeof=lambda size: size, policy=policy)
+    for key, size in trace:
+        cache.compute(key, lambda: size)
+    return cache.get_stats()
+
+def run_threads(cache, threads, accesses=20000, keys=2000):
+    def worker(seed):
+        generator = random.Random(seed)
+        for i in xrange(accesses):
+            # A few popular keys and a long tail, the misses take a while
+            # (without holding the GIL, like decoding an image):
+            key = int(generator.paretovariate(1.0)) % keys
+            cache.compute(key, lambda: time.sleep(0.0001) or 1)
+
+    workers = [Thread(target=worker, args=(seed,)) for seed in range(threads)]
+    start = time.time()
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    return threads * accesses / (time.time() - start)
+
+def benchmark_threads(thread_counts):
+    print "%10s %15s" % ("threads", "accesses")
+    for threads in thread_counts:
+        throughput = run_threads(Cache(limit=500, policy=Cache.SLRU), threads)
+        print "%10d %13d/s" % (threads, throughput)
+
+def main():
+    parser = OptionParser(usage="usage: %prog [options] [trace-file]")
+    parser.add_option("-s", "--synthetic", action="store_true",
+                      help="Use a synthetic navigation trace")
+    parser.add_option("-b", "--budget", type="int", action="append",
+                      help="Cache size (in MB) to test, can be repeated")
+    parser.add_option("-t", "--threads", type="int", action="append",
+                      help="Measure the throughput with this number of "
+                           "threads, can be repeated")
+    (options, args) = parser.parse_args()
+
+    if options.threads:
+        benchmark_threads(options.threads)
+        return
+
+    if args:
+        trace = read_trace(args[0])
+    elif options.synthetic:
+        trace = synthetic_trace()
+    else:
+        parser.print_help()
+        sys.exit(1)
+
+    budgets = options.budget or [128, 256, 512, 1024]
+
+    print "%d accesses" % len(trace)
+    print "%10s %10s %10s %10s" % ("budget", "policy", "hit rate", "evictions")
+    for budget in budgets:
+        for policy in Cache.LRU, Cache.SLRU:
+            stats = replay(trace, policy, budget * MB)
+            requests = stats["hits"] + stats["misses"]
+            print "%8dMB %10s %9.1f%% %10d" % (budget, policy,
+                                              100.0 * stats["hits"] / requests,
+                                              stats["evictions"])
+
+if __name__ == "__main__":
+    main()
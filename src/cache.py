@@ -1,86 +1,372 @@
 # Cache implementation
+import os
 import time
 
-from threading import Lock
+from threading import Lock, Event
+from collections import OrderedDict
+
+from cancellation import Cancelled, check_cancelled
+
+# Usage statistics of a cache or of a cached method:
+class Stats:
+    # Upper bounds (in seconds) of the buckets of the latency histogram
+    # of the misses (the time spent generating the values):
+    LATENCY_BUCKETS = [0.001, 0.01, 0.1, 1.0, 10.0]
+
+    def __init__(self):
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.entries = 0
+        self.bytes = 0
+        self.latencies = [0] * (len(self.LATENCY_BUCKETS) + 1)
+
+    def add_hit(self):
+        with self.lock:
+            self.hits += 1
+
+    def add_miss(self):
+        with self.lock:
+            self.misses += 1
+
+    def add_eviction(self):
+        with self.lock:
+            self.evictions += 1
+
+    def add_entry(self, size):
+        with self.lock:
+            self.entries += 1
+            self.bytes += size
+
+    def remove_entry(self, size):
+        with self.lock:
+            self.entries -= 1
+            self.bytes -= size
+
+    def add_latency(self, seconds):
+        index = 0
+        while (index < len(self.LATENCY_BUCKETS) and 
+               seconds > self.LATENCY_BUCKETS[index]):
+            index += 1
+        with self.lock:
+            self.latencies[index] += 1
+
+    @classmethod
+    def get_bucket_names(cls):
+        names = ["<%gs" % bound for bound in cls.LATENCY_BUCKETS]
+        return names + [">%gs" % cls.LATENCY_BUCKETS[-1]]
+
+    def get_dict(self):
+        with self.lock:
+            return {"hits" : self.hits,
+                    "misses" : self.misses,
+                    "evictions" : self.evictions,
+                    "entries" : self.entries,
+                    "bytes" : self.bytes,
+                    "latencies" : dict(zip(self.get_bucket_names(),
+                                           self.latencies))}
+
+# Registries used to report the statistics. Only named caches are 
+# registered, and only their entries are accounted as resident in the
+# stats of each method (the per-instance caches are unbounded and 
+# released along with their instance):
+caches = []
+method_stats = {}
+method_stats_lock = Lock()
+
+def get_method_stats(name):
+    with method_stats_lock:
+        if not name in method_stats:
+            method_stats[name] = Stats()
+        return method_stats[name]
+
+def get_stats():
+    return {"caches" : dict((cache.name, cache.get_stats()) 
+                            for cache in caches),
+            "methods" : dict((name, stats.get_dict()) 
+                             for name, stats in method_stats.items())}
+
+# Value being computed by a thread, other threads requesting the 
+# same key wait for it instead of computing it again:
+class PendingEntry:
+    def __init__(self):
+        self.event = Event()
+        self.value = None
+        self.error = None
+
+    def wait(self):
+        self.event.wait()
+        if self.error:
+            raise self.error
+        return self.value
 
 class Cache:
-    def __init__(self, limit=None, shared=False, debug=False, top_cache=None):
+    # Eviction policies:
+    LRU = "lru"
+    # Segmented LRU: new items go to a probation segment, and only items
+    # hit again are promoted to a protected segment. Items used just once
+    # (e.g. in a sweep through all the files) are evicted first, instead
+    # of flushing the working set:
+    SLRU = "slru"
+    # Maximum proportion of the cache used by the protected segment:
+    PROTECTED_RATIO = 0.5
+
+    def __init__(self, limit=None, shared=False, debug=False, top_cache=None,
+                       max_bytes=None, sizeof=None, name=None, pinnable=None,
+                       policy=LRU):
+        self.name = name
+        self.policy = policy
         self.limit = limit
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.pinnable = pinnable
         self.shared = shared
         self.debug = debug
 
-        self.keys = []
+        # The segments keep the keys in LRU order (oldest first), so 
+        # refreshing, evicting and removing a key are constant time (the
+        # protected segment is only used by the SLRU policy):
         self.lock = Lock()
         self.store = {}
-        self.hits = 0
-        self.misses = 0
+        self.probation = OrderedDict()
+        self.protected = OrderedDict()
+        self.sizes = {}
+        self.total_bytes = 0
+        self.protected_bytes = 0
+        self.trace_file = None
+        self.pinned = set()
+        self.pending = {}
+        self.stats = Stats()
+        self.key_stats = {}
         self.chained = []
 
         if top_cache:
             top_cache.add_chained(self)
 
-    def __add_key(self, key):
-        if self.limit is None:
-            return
+        if name:
+            caches.append(self)
 
-        if len(self.keys) == self.limit:
-            older = self.keys.pop(0)
-            del self.store[older]
+    def get_stats(self):
+        return self.stats.get_dict()
 
-        self.keys.append(key)
+    def bounded(self):
+        return self.limit is not None or self.max_bytes is not None
+
+    def set_max_bytes(self, max_bytes):
+        with self.lock:
+            self.max_bytes = max_bytes
+            self.__evict()
+
+    def pin(self, owners):
+        # Entries whose owner (the first element of the key, which for
+        # non-shared caches is the hash of the instance) is pinned are
+        # never evicted (unless the pinnable function, if given, 
+        # excludes them). Each call replaces the previous set of owners:
+        with self.lock:
+            self.pinned = set(owners)
+            self.__evict()
+
+    def is_pinned(self, key):
+        return (self.pinned and type(key) is tuple and 
+                key and key[0] in self.pinned and
+                (not self.pinnable or self.pinnable(key)))
+
+    def set_trace_file(self, trace_file):
+        # Record every access (see benchmark.py):
+        self.trace_file = trace_file
+
+    def over_limit(self):
+        if self.limit is not None and len(self.store) > self.limit:
+            return True
+        if self.max_bytes is not None and self.total_bytes > self.max_bytes:
+            return True
+        return False
+
+    def protected_over_limit(self):
+        if (self.limit is not None and 
+            len(self.protected) > self.limit * self.PROTECTED_RATIO):
+            return True
+        if (self.max_bytes is not None and 
+            self.protected_bytes > self.max_bytes * self.PROTECTED_RATIO):
+            return True
+        return False
+
+    def __get_victim(self, keep):
+        for segment in self.probation, self.protected:
+            for key in segment:
+                if key != keep and not self.is_pinned(key):
+                    return key
+        return None
+
+    def __evict(self, keep=None):
+        while self.over_limit():
+            # The most recent key is never evicted, otherwise an item
+            # bigger than the whole budget would never be cached:
+            victim = self.__get_victim(keep)
+            if victim is None:
+                return
+            self.trace("Evicting", victim)
+            self.stats.add_eviction()
+            if victim in self.key_stats:
+                self.key_stats[victim].add_eviction()
+            self.__remove_key(victim)
+
+    def __remove_key(self, key):
+        del self.store[key]
+        size = self.sizes.pop(key, 0)
+        self.total_bytes -= size
+        if key in self.protected:
+            del self.protected[key]
+            self.protected_bytes -= size
+        else:
+            del self.probation[key]
+        self.stats.remove_entry(size)
+        if key in self.key_stats:
+            self.key_stats.pop(key).remove_entry(size)
+        self.on_key_removed(key)
 
     def __refresh_key(self, key):
-        if self.limit is None:
+        if not self.bounded():
             return
 
-        del self.keys[self.keys.index(key)]
-        self.keys.append(key)
+        if key in self.protected:
+            self.protected[key] = self.protected.pop(key)
+        elif self.policy == self.SLRU:
+            # Promote it, and demote the oldest protected keys to the
+            # most recent positions of the probation segment if needed:
+            del self.probation[key]
+            self.protected[key] = None
+            self.protected_bytes += self.sizes.get(key, 0)
+            while len(self.protected) > 1 and self.protected_over_limit():
+                demoted, _ = self.protected.popitem(last=False)
+                self.protected_bytes -= self.sizes.get(demoted, 0)
+                self.probation[demoted] = None
+        else:
+            self.probation[key] = self.probation.pop(key)
+
+    def __add_key(self, key, value, stats=None):
+        self.store[key] = value
+        self.probation[key] = None
+        if self.sizeof:
+            self.sizes[key] = self.sizeof(value)
+            self.total_bytes += self.sizes[key]
+        size = self.sizes.get(key, 0)
+        self.stats.add_entry(size)
+        if stats and self.name:
+            self.key_stats[key] = stats
+            stats.add_entry(size)
+        self.on_key_added(key)
+        self.__evict(keep=key)
+
+    # Hooks for subclasses (invoked with the lock held):
+    def on_key_added(self, key):
+        pass
+
+    def on_key_removed(self, key):
+        pass
 
     def __setitem__(self, key, value):
         with self.lock:
-            # This can happen in a race between two threads that couldn't
-            # get an item from the cache, and then invoke the original method
-            # and try to update the cache using the same key. The cache is locked
-            # during the get() and set() operations to mantain the consistency,
-            # but it's not locked during the whole check-fail-generate-store cycle
-            # since that would generate a big bottle neck and would prevent two
-            # different threads from checking, generating and storing different items.
-            # To avoid working in the same item in parallel, additional locking in 
-            # the object is necessary
+            # This can happen if the cache is updated manually by two 
+            # threads that couldn't get the same item. Use compute() to
+            # avoid generating the same item twice.
             if key in self.store:
                 print "Warning, duplicate entry for", key
                 return
-            self.__add_key(key)
-            self.store[key] = value
+            self.__add_key(key, value)
 
     def __getitem__(self, key):
         with self.lock:
             try:
                 value = self.store[key]
                 self.trace(key, "found in the cache")
-                self.hits += 1
+                self.stats.add_hit()
                 self.__refresh_key(key)
                 return value
             except:
-                self.misses += 1
+                self.stats.add_miss()
+                raise
+
+    def compute(self, key, func, stats=None):
+        # The cache is NOT locked while the value is generated (that 
+        # would prevent different threads from generating different
+        # items), but only the first thread that misses a key generates
+        # it. The rest wait for that result:
+        with self.lock:
+            if key in self.store:
+                self.trace(key, "found in the cache")
+                self.stats.add_hit()
+                if stats: stats.add_hit()
+                self.__refresh_key(key)
+                self.record(key)
+                return self.store[key]
+
+            self.stats.add_miss()
+            if stats: stats.add_miss()
+            pending = self.pending.get(key)
+            if pending is None:
+                pending = self.pending[key] = PendingEntry()
+                owner = True
+            else:
+                owner = False
+
+        if not owner:
+            self.trace(key, "being generated by another thread, waiting")
+            try:
+                return pending.wait()
+            except Cancelled:
+                # The job generating it was cancelled, but this thread 
+                # still needs the value (unless it was cancelled too):
+                check_cancelled()
+                return self.compute(key, func, stats)
+
+        try:
+            try:
+                start = time.time()
+                pending.value = func()
+                elapsed = time.time() - start
+                self.stats.add_latency(elapsed)
+                if stats: stats.add_latency(elapsed)
+                self.trace(key, "NOT found in the cache, value obtained in", 
+                           elapsed, "seconds")
+            except BaseException, e:
+                pending.error = e
                 raise
 
+            with self.lock:
+                del self.pending[key]
+                self.__add_key(key, pending.value, stats)
+                self.record(key)
+        finally:
+            # (whatever happened, the waiting threads must be woken up)
+            with self.lock:
+                self.pending.pop(key, None)
+            pending.event.set()
+
+        return pending.value
+
+    def peek(self, key):
+        # (not accounted as a hit, nor refreshed)
+        with self.lock:
+            return self.store.get(key)
+
+    def record(self, key):
+        if self.trace_file:
+            self.trace_file.write("%d %d\n" % (hash(key), 
+                                               self.sizes.get(key, 0)))
+
     def add_chained(self, chained):
         self.chained.append(chained)
 
-    def invalidate(self, partial_key):
-        matches = []
+    def get_matches(self, partial_key):
+        return [key for key in self.store if partial_key in key]
 
+    def invalidate(self, partial_key):
         with self.lock:
-            for key in self.store:
-                if partial_key in key:
-                    matches.append(key)
-
-            for key in matches:
+            for key in self.get_matches(partial_key):
                 self.trace("Invalidating", key)
-                del self.store[key]
-                if self.keys:
-                    self.keys.remove(key)
+                self.__remove_key(key)
 
         for chained in self.chained:
             chained.invalidate(partial_key)
@@ -88,45 +374,88 @@ class Cache:
     def trace(self, *args):
         if self.debug: print " ".join(map(str,args))
 
+# Cache of values obtained from a directory. Keys are indexed by the
+# directory they belong to (obtained with path_func), so invalidating
+# a directory only touches its own entries (and not the ones of other
+# directories with a similar name):
+class DirectoryCache(Cache):
+    def __init__(self, path_func, **kwargs):
+        Cache.__init__(self, shared=True, **kwargs)
+        self.path_func = path_func
+        self.index = {}
+
+    def get_path(self, key):
+        return os.path.abspath(self.path_func(key))
+
+    def on_key_added(self, key):
+        self.index.setdefault(self.get_path(key), set()).add(key)
+
+    def on_key_removed(self, key):
+        path = self.get_path(key)
+        keys = self.index[path]
+        keys.discard(key)
+        if not keys:
+            del self.index[path]
+
+    def get_matches(self, directory):
+        return list(self.index.get(os.path.abspath(directory), ()))
+
 def cached(cache_=None, key_func=None):
     def func(method):
-        def wrapper(self, *args, **kwargs):
+        def get_cache(self):
             # select the cache:
             if not cache_:
                 if not hasattr(self, "__cache__"):
                     self.__cache__ = Cache()
-                cache = self.__cache__
+                return self.__cache__
             else:
-                cache = cache_
-    
-            # build the key:
+                return cache_
+
+        def get_key(self, cache, args, kwargs):
             if key_func:
-                key = key_func(self)
-            else:
-                key = tuple()
+                return key_func(self)
+
+            key = tuple()
+
+            # if the cache is shared, self must NOT be
+            # included in the key (so multiple instances
+            # calling the same method with the same args
+            # share the same result).
+            if not cache.shared:
+                key += (hash(self),)
 
-                # if the cache is shared, self must NOT be
-                # included in the key (so multiple instances
-                # calling the same method with the same args
-                # share the same result).
-                if not cache.shared:
-                    key += (hash(self),)
+            key += (method.__name__,)
+            key += args
+            key += tuple(kwargs.items())
+            return key
 
-                key += (method.__name__,)
-                key += args
-                key += tuple(kwargs.items())
+        # The stats of the method by class, so the registry (and its 
+        # lock) is only used the first time each class calls it:
+        class_stats = {}
+
+        def get_stats(self):
+            stats = class_stats.get(self.__class__)
+            if stats is None:
+                stats = get_method_stats("%s.%s" % (self.__class__.__name__,
+                                                    method.__name__))
+                class_stats[self.__class__] = stats
+            return stats
+
+        def wrapper(self, *args, **kwargs):
+            cache = get_cache(self)
+            key = get_key(self, cache, args, kwargs)
 
             # access/update the cache: 
-            # (this is NOT locked -see cache.__setitem__-)
-            try:
-                return cache[key]
-            except:
-                start = time.time()
-                value = method(self, *args, **kwargs)
-                cache.trace(key, "NOT found in the cache, value obtained in", 
-                            time.time() - start, "seconds")
-                cache[key] = value
-                return value
+            # (see cache.compute)
+            return cache.compute(key, lambda: method(self, *args, **kwargs),
+                                 get_stats(self))
+
+        # Returns the cached value (None if it's not in the cache) without
+        # generating it, e.g.: file_.get_thumbnail.peek(file_, size)
+        def peek(self, *args, **kwargs):
+            cache = get_cache(self)
+            return cache.peek(get_key(self, cache, args, kwargs))
+
+        wrapper.peek = peek
         return wrapper
     return func
-
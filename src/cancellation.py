@@ -0,0 +1,64 @@
+# Cooperative cancellation of the jobs run in the background. Each job
+# runs with a token (see threads.Worker) that the slow paths (decoding,
+# external processes) check, so a job whose result is no longer wanted
+# stops as soon as possible:
+from threading import Lock, local
+
+class Cancelled(Exception):
+    pass
+
+class CancellationToken:
+    def __init__(self):
+        self.lock = Lock()
+        self.cancelled = False
+        self.callbacks = []
+
+    def cancel(self):
+        with self.lock:
+            if self.cancelled:
+                return
+            self.cancelled = True
+            callbacks = self.callbacks
+            self.callbacks = []
+
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception, e:
+                print "Warning:", e
+
+    def is_cancelled(self):
+        return self.cancelled
+
+    def check(self):
+        if self.cancelled:
+            raise Cancelled()
+
+    # The callback is invoked (from the thread that cancels the token)
+    # when the token is cancelled, or right away if it already was:
+    def add_callback(self, callback):
+        with self.lock:
+            if not self.cancelled:
+                self.callbacks.append(callback)
+                return
+        callback()
+
+    def remove_callback(self, callback):
+        with self.lock:
+            if callback in self.callbacks:
+                self.callbacks.remove(callback)
+
+# Token of the job being run by each thread (None if it can't be
+# cancelled), so it doesn't have to be passed through all the calls:
+current = local()
+
+def get_current_token():
+    return getattr(current, "token", None)
+
+def set_current_token(token):
+    current.token = token
+
+def check_cancelled():
+    token = get_current_token()
+    if token:
+        token.check()
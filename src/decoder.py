@@ -0,0 +1,109 @@
+# Optional decoding of the images in a pool of processes (with PIL), so
+# CPU-heavy decodes aren't serialized by the GIL. The workers write the
+# raw pixels to a file in shared memory (/dev/shm), and the viewer
+# builds the pixbuf from it (copying them, see DecoderPool.decode).
+import os
+import tempfile
+import multiprocessing
+
+from threading import Lock
+
+import gtk
+
+from PIL import Image as PILImage
+
+from cancellation import Cancelled, check_cancelled
+
+def get_shared_memory_dir():
+    if os.path.isdir("/dev/shm"):
+        return "/dev/shm"
+    return tempfile.gettempdir()
+
+# Run in the worker processes:
+def decode_image(filename, size, output_dir):
+    image = PILImage.open(filename)
+
+    if size:
+        # JPEG images are decoded directly at a reduced scale:
+        image.draft("RGB", (size, size))
+        image.thumbnail((size, size), PILImage.ANTIALIAS)
+
+    has_alpha = image.mode in ("RGBA", "LA") or "transparency" in image.info
+    image = image.convert("RGBA" if has_alpha else "RGB")
+    to_bytes = getattr(image, "tobytes", None) or image.tostring
+
+    fd, path = tempfile.mkstemp(prefix="gtk-viewer-", dir=output_dir)
+    try:
+        os.write(fd, to_bytes())
+    except:
+        os.close(fd)
+        os.unlink(path)
+        raise
+    os.close(fd)
+
+    return path, image.size, has_alpha
+
+class DecoderPool:
+    # The interval (in seconds) at which a waiting job checks if it was
+    # cancelled:
+    POLL_INTERVAL = 0.05
+
+    def __init__(self, processes):
+        # (started before the GUI, forking a process with the GTK main
+        # loop running is asking for trouble)
+        self.pool = multiprocessing.Pool(processes)
+        self.output_dir = get_shared_memory_dir()
+
+    def stop(self):
+        self.pool.terminate()
+
+    # Decodes the image (downscaled to fit in size x size if given):
+    def decode(self, filename, size=None):
+        # If the job is cancelled, the output is removed as soon as
+        # it's ready:
+        lock = Lock()
+        state = {}
+
+        def on_ready(output):
+            with lock:
+                state["output"] = output
+                if state.get("abandoned"):
+                    os.unlink(output[0])
+
+        result = self.pool.apply_async(decode_image,
+                                       (filename, size, self.output_dir),
+                                       callback=on_ready)
+        try:
+            path, (width, height), has_alpha = self.wait(result)
+        except Cancelled:
+            with lock:
+                state["abandoned"] = True
+                if "output" in state:
+                    os.unlink(state["output"][0])
+            raise
+
+        try:
+            with open(path, "rb") as input_:
+                data = input_.read()
+        finally:
+            os.unlink(path)
+
+        # The pixels are copied twice: the file is read into a string,
+        # and pixbuf_new_from_data copies the string again (pygtk only
+        # takes strings, so mapping the file wouldn't save the first one)
+        channels = 4 if has_alpha else 3
+        return gtk.gdk.pixbuf_new_from_data(data, gtk.gdk.COLORSPACE_RGB,
+                                            has_alpha, 8, width, height,
+                                            width * channels)
+
+    # Runs func(*args) in a worker process:
+    def call(self, func, *args):
+        return self.wait(self.pool.apply_async(func, args))
+
+    def wait(self, result):
+        while True:
+            check_cancelled()
+            try:
+                return result.get(self.POLL_INTERVAL)
+            except multiprocessing.TimeoutError:
+                pass
@@ -1,6 +1,10 @@
 import time
 import datetime
 import gtk
+import gobject
+
+from imagefile import Size
+from cache import Stats
 
 class AboutDialog:
     def __init__(self, parent):
@@ -165,3 +169,61 @@ class ProgressBarDialog:
         self.progressbar.set_text("%d%% (%s left)" % (fraction*100, remaining))
         self.progressbar.set_fraction(fraction)
 
+
+class CacheStatsDialog:
+    REFRESH_INTERVAL = 1000 # milliseconds
+
+    def __init__(self, parent, get_stats):
+        self.get_stats = get_stats
+
+        self.window = gtk.Dialog(title="Cache statistics", parent=parent)
+        self.window.set_default_size(900, 400)
+        self.window.connect("destroy", self.on_destroy)
+
+        columns = (["Name", "Hits", "Misses", "Hit rate", "Evictions",
+                    "Entries", "Size"] + Stats.get_bucket_names())
+
+        self.store = gtk.ListStore(*([str] * len(columns)))
+
+        treeview = gtk.TreeView(self.store)
+        for index, column in enumerate(columns):
+            renderer = gtk.CellRendererText()
+            treeview.append_column(gtk.TreeViewColumn(column, renderer, 
+                                                      text=index))
+
+        scrolled = gtk.ScrolledWindow()
+        scrolled.set_policy(gtk.POLICY_AUTOMATIC, gtk.POLICY_AUTOMATIC)
+        scrolled.add(treeview)
+        self.window.vbox.pack_start(scrolled, True, True, 5)
+
+        self.timeout_id = None
+
+    def show(self):
+        self.refresh()
+        self.window.show_all()
+        self.timeout_id = gobject.timeout_add(self.REFRESH_INTERVAL, 
+                                              self.refresh)
+
+    def on_destroy(self, widget):
+        if self.timeout_id:
+            gobject.source_remove(self.timeout_id)
+
+    def refresh(self):
+        stats = self.get_stats()
+
+        self.store.clear()
+        for section in ["caches", "methods"]:
+            for name, values in sorted(stats[section].items()):
+                total = values["hits"] + values["misses"]
+                rate = (100.0 * values["hits"] / total) if total else 0
+                self.store.append([name, 
+                                   str(values["hits"]),
+                                   str(values["misses"]),
+                                   "%.1f%%" % rate,
+                                   str(values["evictions"]),
+                                   str(values["entries"]),
+                                   str(Size(values["bytes"]))] + 
+                                  [str(values["latencies"][bucket])
+                                   for bucket in Stats.get_bucket_names()])
+
+        return True # keep the timeout active
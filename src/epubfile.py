@@ -6,15 +6,17 @@ from xml.dom import minidom
 import gtk
 import gio
 
-from imagefile import ImageFile, GTKIconImage
-from cache import Cache, cached
+from imagefile import ImageFile, GTKIconImage, mark_placeholder
+from cache import cached
+from threads import Lane
 
 class EPUBFile(ImageFile):
     description = "epub"
     valid_extensions = ["epub"]
-    pixbuf_cache = Cache(10)
+    # (the cover is decoded in this process)
+    lane = Lane.CPU
 
-    @cached(pixbuf_cache)
+    @cached(ImageFile.pixbuf_cache)
     def get_pixbuf(self):
         cover = self.get_cover()
 
@@ -23,7 +25,8 @@ class EPUBFile(ImageFile):
             return gtk.gdk.pixbuf_new_from_stream(stream)
         else:
             print "Warning: unable to preview EPUB file '%s'" % self.get_basename()
-            return GTKIconImage(gtk.STOCK_MISSING_IMAGE, 256).get_pixbuf()
+            icon = GTKIconImage(gtk.STOCK_MISSING_IMAGE, 256).get_pixbuf()
+            return mark_placeholder(icon.copy())
 
     def get_cover(self):
         epub = zipfile.ZipFile(self.filename, "r")
@@ -1,5 +1,8 @@
 import os
 import copy
+import time
+
+from collections import deque
 
 from filefactory import FileFactory
 from filescanner import FileScanner
@@ -77,9 +80,16 @@ class FileList:
                 self.actual.append(file_)
 
 class FileManager:
+    # The navigation speed is measured over the moves of the last 
+    # VELOCITY_WINDOW seconds:
+    VELOCITY_WINDOW = 2.0
+
     def __init__(self, on_list_modified=lambda: None):
         self.filelist = FileList()
         self.index = 0
+        # Direction of the last move (+1 forward, -1 backward):
+        self.direction = 1
+        self.moves = deque(maxlen=32)
 
         self.on_list_modified = on_list_modified
 
@@ -98,6 +108,23 @@ class FileManager:
     def get_next_file(self):
         return self.filelist.get_item_at(self.index + 1)
 
+    # The next files in the direction of travel (the ones most likely to
+    # be viewed next):
+    @if_empty(lambda: [])
+    def get_files_ahead(self, count):
+        count = min(count, self.filelist.get_length() - 1)
+        return [self.filelist.get_item_at(self.index + self.direction * step)
+                for step in range(1, count + 1)]
+
+    # Moves per second (0 if the user stopped):
+    def get_velocity(self):
+        now = time.time()
+        recent = [move for move in self.moves 
+                  if now - move < self.VELOCITY_WINDOW]
+        if len(recent) < 2:
+            return 0.0
+        return (len(recent) - 1) / max(now - recent[0], 0.001)
+
     @if_empty(lambda: -1)
     def get_current_index(self):
         return self.index
@@ -120,6 +147,8 @@ class FileManager:
 
     @skip_if_empty
     def go_forward(self, steps):
+        self.direction = 1
+        self.moves.append(time.time())
         self.index += steps
         if self.index >= self.filelist.get_length():
             self.index = self.index - self.filelist.get_length()
@@ -127,6 +156,8 @@ class FileManager:
 
     @skip_if_empty
     def go_backward(self, steps):
+        self.direction = -1
+        self.moves.append(time.time())
         self.index -= steps
         if self.index < 0:
             self.index = self.filelist.get_length() + self.index
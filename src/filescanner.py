@@ -10,7 +10,7 @@ from pdffile import PDFFile
 from epubfile import EPUBFile
 from archivefile import ArchiveFile
 
-from cache import Cache, cached
+from cache import DirectoryCache, cached
 
 class FileFilter:
     STARRED   = "starred"
@@ -101,7 +101,9 @@ class FileFilter:
                 self.matches_pattern(file_.get_filename()))
 
 class FileScanner:
-    cache = Cache(shared=True)
+    # Keys are (method name, directory):
+    cache = DirectoryCache(path_func=lambda key: key[1], limit=10000,
+                           name="directory scans")
 
     def __init__(self, filter_ = None, recursive = False):
         if filter_:
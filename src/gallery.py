@@ -11,9 +11,9 @@ from filemanager import FileManager
 from thumbnail import DirectoryThumbnail
 from dialogs import NewFolderDialog, ProgressBarDialog
 
-from cache import Cache, cached
+from cache import DirectoryCache, cached
 from system import execute
-from threads import Worker, Updater
+from threads import Worker, Updater, Priority
 
 class GalleryItem:
     def __init__(self, item, size):
@@ -29,6 +29,9 @@ class GalleryItem:
     def on_selected(self, gallery):
         pass
 
+    def get_lane(self):
+        return self.item.lane
+
 class ImageItem(GalleryItem):
     def __init__(self, item, size):
         GalleryItem.__init__(self, item, size)
@@ -42,7 +45,7 @@ class ImageItem(GalleryItem):
     @cached()
     def final_data(self):
         width, height = self.item.get_dimensions_to_fit(self.size, self.size)
-        return (self.item.get_pixbuf_at_size(width, height),
+        return (self.item.get_thumbnail_at_size(width, height),
                 "%s\n<span size='small'>%s\n%s</span>" % \
                     (self.item.get_basename(),
                      self.item.get_dimensions(),
@@ -75,9 +78,15 @@ class DirectoryItem(GalleryItem):
     def on_selected(self, gallery):
         gallery.on_dir_selected(self.item)
 
+    def get_lane(self):
+        return self.thumbnail.lane
+
 class SelectorListStoreBuilder:
-    liststore_cache = Cache(shared=True, 
-                            top_cache=FileScanner.cache)
+    # Keys are (directory, filter):
+    liststore_cache = DirectoryCache(path_func=lambda key: key[0],
+                                     limit=16,
+                                     top_cache=FileScanner.cache,
+                                     name="gallery liststores")
 
     def __init__(self, directory, filter_, thumb_size):
         self.directory = directory
@@ -318,8 +327,7 @@ class GallerySelector:
         settings.props.gtk_button_images = True
 
         # Data initialization:
-        self.loader = Worker()
-        self.loader.start()
+        self.loader = Worker(Priority.GALLERY)
 
         self.curdir = os.path.realpath(os.path.expanduser(dirname))
         self.last_filter = ""
@@ -338,7 +346,8 @@ class GallerySelector:
         updater = Updater(builder.build(),
                           dialog.update,
                           self.on_model_ready,
-                          (builder, dialog))
+                          (builder, dialog),
+                          Priority.GALLERY)
         updater.start()
 
     def on_model_ready(self, builder, dialog):
@@ -348,7 +357,8 @@ class GallerySelector:
         for index, item in enumerate(builder.items):
             # Schedule an update on this item:
             self.loader.push((self.update_item_thumbnail, 
-                             (builder.liststore, index, item)))
+                             (builder.liststore, index, item)), 
+                             key=index, lane=item.get_lane())
 
         # Update the items list:
         self.items = builder.items
@@ -408,7 +418,7 @@ class GallerySelector:
         dialog.run()
 
     def on_open_nautilus(self, widget):
-        execute(["nautilus", self.curdir])
+        execute(["nautilus", self.curdir], bounded=False)
 
     def on_refresh(self, widget):
         FileManager().on_dir_changed(self.curdir)
@@ -548,8 +558,7 @@ class GalleryViewer:
         vbox.pack_start(scrolled, True, True, 0)
 
         # Data initialization:
-        self.loader = Worker()
-        self.loader.start()
+        self.loader = Worker(Priority.GALLERY)
         self.files = files
         self.items = []
         
@@ -565,7 +574,8 @@ class GalleryViewer:
         updater = Updater(builder.build(),
                           dialog.update,
                           self.on_model_ready,
-                          (builder, dialog))
+                          (builder, dialog),
+                          Priority.GALLERY)
         updater.start()
 
     def on_model_ready(self, builder, dialog):
@@ -575,7 +585,8 @@ class GalleryViewer:
         for index, item in enumerate(builder.items):
             # Schedule an update on this item:
             self.loader.push((self.update_item_thumbnail, 
-                             (builder.liststore, index, item)))
+                             (builder.liststore, index, item)), 
+                             key=index, lane=item.get_lane())
 
         # Update the items list:
         self.items = builder.items
@@ -1,17 +1,16 @@
 import os
 import gtk
-import pexpect
 
 from imagefile import ImageFile
-from cache import Cache, cached
+from cache import cached
 
-from system import execute
+from system import execute, stream
 from threads import yield_processor
+from cancellation import check_cancelled
 
 class GIFFile(ImageFile):
     description = "gif"
     valid_extensions = ["gif"]
-    pixbuf_anim_cache = Cache(10)
 
     def __init__(self, filename):
         ImageFile.__init__(self, filename)
@@ -24,15 +23,16 @@ class GIFFile(ImageFile):
         if self.anim_enabled:
             widget.set_from_animation(self.get_pixbuf_anim_at_size(width, height))
         else:
-            widget.set_from_pixbuf(self.get_pixbuf_at_size(width, height))
+            ImageFile.draw(self, widget, width, height)
 
-    @cached(pixbuf_anim_cache)
+    @cached(ImageFile.pixbuf_cache)
     def get_pixbuf_anim_at_size(self, width, height):
         loader = gtk.gdk.PixbufLoader()
         loader.set_size(width, height)
         with open(self.get_filename(), "r") as input_:
             buf = input_.read(8192)
             while buf:
+                check_cancelled()
                 loader.write(buf)
                 yield_processor() # Otherwise the UI will lock...
                 buf = input_.read(8192)
@@ -46,22 +46,14 @@ class GIFFile(ImageFile):
             basename, _, ext = self.get_basename().rpartition(".")
             tmp_root = os.path.join(tmp_dir, "%s_%%04d.%s" % (basename, ext))
             # http://www.imagemagick.org/Usage/anim_basics/#coalesce
-            child = pexpect.spawn("convert", ["-verbose",
-                                              self.get_filename(), 
-                                              "-coalesce", 
-                                              tmp_root])
-
             index = 0
-            while True:
-                try:
-                    child.expect(self.get_filename() + "\=\>")
+            for line in stream(["convert", "-verbose",
+                                self.get_filename(), 
+                                "-coalesce", 
+                                tmp_root]):
+                if self.get_filename() + "=>" in line:
                     index += 1
-                except pexpect.TIMEOUT:
-                    pass
                 yield float(index) / total
-
-        except pexpect.EOF:
-            pass
         except Exception, e:
             print "Warning:", e
 
@@ -71,20 +63,13 @@ class GIFFile(ImageFile):
 class GIFGenerator:
     def generate(self, files, output, geometry, colors, delay):
         try:
-            child = pexpect.spawn("convert", ["-verbose",
-                                              "-geometry", str(geometry),
-                                              "-colors", str(colors),
-                                              "-delay", str(delay)] +
-                                              files + 
-                                              [output])
-            while True:
-                try:
-                    child.expect("\=\>" + output, 0.1)
-                except pexpect.TIMEOUT:
-                    pass
+            for line in stream(["convert", "-verbose",
+                                "-geometry", str(geometry),
+                                "-colors", str(colors),
+                                "-delay", str(delay)] +
+                               files + 
+                               [output]):
                 yield None
-        except pexpect.EOF:
-            pass
         except Exception, e:
             print "Warning:", e
 
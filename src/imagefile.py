@@ -3,6 +3,7 @@ import time
 import shutil
 import hashlib
 import string
+import struct
 
 import gtk
 
@@ -10,7 +11,128 @@ from PIL import Image as PILImage
 from PIL.ExifTags import TAGS as PILExifTags
 
 from cache import Cache, cached
+from cancellation import Cancelled, check_cancelled
+from metacache import persistent
 from system import trash, untrash, external_open
+from thumbcache import ThumbnailCache
+from threads import Lane
+
+# Default memory budget for the decoded images (can be changed from
+# the command line):
+PIXBUF_CACHE_SIZE = 512 * 1024 * 1024
+
+# Memory budget for the images rendered at the size they are drawn:
+RENDER_CACHE_SIZE = 128 * 1024 * 1024
+
+# gdk-pixbuf doesn't expose the number of frames of an animation, so
+# the memory used by an animation is estimated with a fixed amount of
+# frames:
+ANIM_FRAMES_ESTIMATE = 16
+
+def get_pixbuf_size(value):
+    if isinstance(value, gtk.gdk.Pixbuf):
+        return value.get_rowstride() * value.get_height()
+    elif isinstance(value, gtk.gdk.PixbufAnimation):
+        return (value.get_width() * value.get_height() * 4 * 
+                ANIM_FRAMES_ESTIMATE)
+    else:
+        return 0
+
+# The pixbufs shown in place of the files that can't be decoded are 
+# marked, so they are never stored as the thumbnails of the files:
+def mark_placeholder(pixbuf):
+    pixbuf.set_data("placeholder", True)
+    return pixbuf
+
+def is_placeholder(pixbuf):
+    return bool(pixbuf.get_data("placeholder"))
+
+# The files are fed to the loader in chunks, so the decoding can be 
+# aborted if the job that requested it is cancelled:
+DECODE_CHUNK_SIZE = 256 * 1024
+
+# If a size is given, the image is loaded at that size (the JPEG loader
+# decodes it directly at 1/2, 1/4 or 1/8 scale when possible):
+def load_pixbuf(filename, size=None):
+    loader = gtk.gdk.PixbufLoader()
+    if size:
+        loader.set_size(*size)
+    complete = False
+    try:
+        with open(filename, "rb") as input_:
+            buf = input_.read(DECODE_CHUNK_SIZE)
+            while buf:
+                check_cancelled()
+                loader.write(buf)
+                buf = input_.read(DECODE_CHUNK_SIZE)
+        complete = True
+    finally:
+        # (if cancelled or failed, the loader is closed anyway, otherwise
+        # gdk-pixbuf warns when it's finalized; the original exception 
+        # is the one raised)
+        if not complete:
+            try:
+                loader.close()
+            except Exception:
+                pass # the image is incomplete
+
+    loader.close()
+    pixbuf = loader.get_pixbuf()
+    if not pixbuf:
+        raise Exception("unable to load '%s'" % filename)
+    return pixbuf
+
+def read_tags(filename):
+    tags = {}
+    try:
+        image = PILImage.open(filename)
+        for tag, value in image._getexif().iteritems():
+            decoded = PILExifTags.get(tag, tag)
+            tags[decoded] = value
+    except Exception, e:
+        pass
+    return tags
+
+# Returns the JPEG preview that cameras embed in the EXIF data (in the
+# IFD1 of its TIFF structure), or None if there isn't any:
+def read_exif_preview(filename):
+    try:
+        exif = PILImage.open(filename).info.get("exif")
+    except Exception:
+        return None
+
+    if not exif or not exif.startswith("Exif\0\0"):
+        return None
+
+    tiff = exif[6:]
+    try:
+        order = {"II" : "<", "MM" : ">"}[tiff[:2]]
+
+        def read_ifd(offset):
+            count, = struct.unpack(order + "H", tiff[offset:offset + 2])
+            end = offset + 2 + count * 12
+            tags = {}
+            for entry in range(offset + 2, end, 12):
+                tag, type_, length, value = struct.unpack(order + "HHLL",
+                                                tiff[entry:entry + 12])
+                tags[tag] = value
+            next_, = struct.unpack(order + "L", tiff[end:end + 4])
+            return tags, next_
+
+        ifd0, = struct.unpack(order + "L", tiff[4:8])
+        tags, ifd1 = read_ifd(ifd0)
+        if not ifd1:
+            return None
+        tags, next_ = read_ifd(ifd1)
+        # JPEGInterchangeFormat and JPEGInterchangeFormatLength:
+        offset, length = tags[0x0201], tags[0x0202]
+    except (KeyError, struct.error):
+        return None
+
+    data = tiff[offset:offset + length]
+    if not data.startswith("\xff\xd8"):
+        return None
+    return data
 
 class ImageDimensions:
     def __init__(self, width, height):
@@ -75,6 +197,7 @@ class File:
         return Size(size)
 
     @cached()
+    @persistent
     def get_sha1(self):
         with open(self.filename, "r") as input_:
             return hashlib.sha1(input_.read()).hexdigest()
@@ -146,7 +269,29 @@ class File:
 
 class ImageFile(File):
     description = "image"
-    pixbuf_cache = Cache(10)
+    # Shared by every file type, so all the decoded images are 
+    # accounted in the same memory budget. The images derived from them
+    # (the pyramid levels, see get_level) are cheap to regenerate, so 
+    # they are never pinned:
+    pixbuf_cache = Cache(max_bytes=PIXBUF_CACHE_SIZE, sizeof=get_pixbuf_size,
+                         name="pixbufs", policy=Cache.SLRU, 
+                         pinnable=lambda key: not key[1].startswith("render_"))
+    # The images rendered at the size they are drawn have their own 
+    # budget: every zoom step or resize renders a new size, which must
+    # not evict the decoded images:
+    render_cache = Cache(max_bytes=RENDER_CACHE_SIZE, sizeof=get_pixbuf_size,
+                         name="renders")
+    thumbnail_cache = ThumbnailCache()
+    # Whether the thumbnails are stored in the thumbnail_cache:
+    persistent_thumbnails = True
+    # Pool of decoder processes (see decoder.py), if enabled:
+    decoder = None
+    # Lane of the thread pool where the images are loaded (see threads):
+    lane = Lane.CPU
+    # Size of the largest monitor, if known. The images are drawn from a
+    # pixbuf that fits in it (the viewer doesn't need more pixels), the
+    # full size image is only decoded when zooming past it:
+    screen_size = None
 
     def __init__(self, filename):
         File.__init__(self, filename)
@@ -154,17 +299,94 @@ class ImageFile(File):
         self.flip_h = False
         self.flip_v = False
 
+    @classmethod
+    def pin_files(cls, files):
+        cls.pixbuf_cache.pin(map(hash, files))
+
+    # Draws the image at width x height in a TiledImage (see 
+    # imageviewer). Bigger than the screen, it's drawn tile by tile from
+    # the nearest level of the pyramid, instead of rendering it at that
+    # size:
     def draw(self, widget, width, height):
-        widget.set_from_pixbuf(self.get_pixbuf_at_size(width, height))
+        if self.fits_in_screen(width, height):
+            widget.set_from_pixbuf(self.get_pixbuf_at_size(width, height))
+        else:
+            widget.set_from_scaled(self.get_level_for_size(width, height,
+                                                           self.get_rotation(),
+                                                           self.flip_h,
+                                                           self.flip_v),
+                                   width, height)
 
     @cached(pixbuf_cache)
     def get_pixbuf(self):
         try:
-            return gtk.gdk.pixbuf_new_from_file(self.get_filename())
+            return self.decode()
+        except Cancelled:
+            raise
         except Exception, e:
             print "Warning:", e
             return self.get_empty_pixbuf()
 
+    # Whether the pixbuf is the decoded file (and not, e.g., a frame of a
+    # video):
+    def is_decoded_from_file(self):
+        return self.__class__.get_pixbuf == ImageFile.get_pixbuf
+
+    def can_be_decoded(self):
+        return self.decoder is not None and self.is_decoded_from_file()
+
+    # Decodes the file (downscaled to about size, a (width, height) tuple,
+    # if given) in the decoder processes if available. Falls back to 
+    # gdk-pixbuf for the formats not supported by PIL:
+    def decode(self, size=None):
+        if self.can_be_decoded():
+            try:
+                return self.decoder.decode(self.get_filename(), 
+                                           max(size) if size else None)
+            except Cancelled:
+                raise
+            except Exception:
+                pass
+
+        return load_pixbuf(self.get_filename(), size)
+
+    # The image (without any rotation applied) downscaled to fit in 
+    # width x height. Unless it's already decoded, it's loaded directly
+    # at that size where the format allows it, which is much faster and
+    # needs less memory than decoding it at full size:
+    def load_at_most(self, width, height):
+        original_width, original_height = self.get_original_size()
+        factor = min(1.0, float(width) / original_width,
+                     float(height) / original_height)
+        if factor == 1.0:
+            return self.get_pixbuf()
+
+        return self.load_at_size(max(1, int(original_width * factor)),
+                                 max(1, int(original_height * factor)))
+
+    @cached(pixbuf_cache)
+    def load_at_size(self, width, height):
+        pixbuf = None
+        if self.get_pixbuf.peek(self) is not None:
+            pixbuf = self.get_level_for_size(width, height, 0, False, False)
+
+        if pixbuf is None and self.is_decoded_from_file():
+            try:
+                pixbuf = self.decode((width, height))
+            except Cancelled:
+                raise
+            except Exception, e:
+                print "Warning:", e
+
+        if pixbuf is None:
+            pixbuf = self.get_pixbuf()
+
+        # (the placeholder is kept as it is, so it's still recognized)
+        if (is_placeholder(pixbuf) or
+            (pixbuf.get_width(), pixbuf.get_height()) == (width, height)):
+            return pixbuf
+        return pixbuf.scale_simple(width, height, gtk.gdk.INTERP_BILINEAR)
+
     def toggle_flip(self, horizontal):
         if horizontal:
             self.flip_h = not self.flip_h
@@ -179,22 +401,243 @@ class ImageFile(File):
         return (self.get_orientation() + self.rotation) % 360
 
     def get_pixbuf_at_size(self, width, height):
+        return self.render_pixbuf(width, height, self.get_rotation(),
+                                  self.flip_h, self.flip_v)
+
+    @cached(render_cache)
+    def render_pixbuf(self, width, height, rotation, flip_h, flip_v):
+        # (sizes of the pixbuf before rotating it)
+        if rotation in (90, 270):
+            source_width, source_height = height, width
+        else:
+            source_width, source_height = width, height
+
+        if self.screen_size is None:
+            pixbuf = self.load_at_most(source_width, source_height)
+        elif self.fits_in_screen(width, height):
+            screen_width, screen_height = self.screen_size
+            if rotation in (90, 270):
+                screen_width, screen_height = screen_height, screen_width
+            pixbuf = self.load_at_most(screen_width, screen_height)
+        else:
+            pixbuf = self.get_level_for_size(source_width, source_height,
+                                             0, False, False)
+
+        return self.transform_pixbuf(pixbuf, width, height,
+                                     rotation, flip_h, flip_v)
+
+    # Levels of the mip-map pyramid of the image (rotated and flipped),
+    # to scale it from the nearest one: level 0 is the full size image,
+    # each level is half the size of the previous one. They are built
+    # when needed, and cached as any other rendered image:
+    def get_level(self, level, rotation, flip_h, flip_v):
+        if level > 0:
+            return self.render_level(level, rotation, flip_h, flip_v)
+        # (not cached twice if there's nothing to do)
+        if not rotation and not flip_h and not flip_v:
+            return self.get_pixbuf()
+        return self.render_full_size(rotation, flip_h, flip_v)
+
+    @cached(pixbuf_cache)
+    def render_level(self, level, rotation, flip_h, flip_v):
+        pixbuf = self.get_level(level - 1, rotation, flip_h, flip_v)
+        return pixbuf.scale_simple(max(1, pixbuf.get_width() / 2),
+                                   max(1, pixbuf.get_height() / 2),
+                                   gtk.gdk.INTERP_BILINEAR)
+
+    # The smallest level that is still at least width x height:
+    def get_level_for_size(self, width, height, rotation, flip_h, flip_v):
+        level_width, level_height = self.get_original_size()
+        if rotation in (90, 270):
+            level_width, level_height = level_height, level_width
+
+        level = 0
+        while (level_width / 2 >= max(1, width) and
+               level_height / 2 >= max(1, height)):
+            level_width, level_height = level_width / 2, level_height / 2
+            level += 1
+
+        return self.get_level(level, rotation, flip_h, flip_v)
+
+    @cached(pixbuf_cache)
+    def render_full_size(self, rotation, flip_h, flip_v):
+        pixbuf = self.get_pixbuf()
+        width, height = pixbuf.get_width(), pixbuf.get_height()
+        if rotation in (90, 270):
+            width, height = height, width
+
+        return self.transform_pixbuf(pixbuf, width, height,
+                                     rotation, flip_h, flip_v)
+
+    def fits_in_screen(self, width, height):
+        return (self.screen_size is None or
+                (width <= self.screen_size[0] and 
+                 height <= self.screen_size[1]))
+
+    def has_pixbuf_at_size(self, width, height):
+        return self.render_pixbuf.peek(self, width, height, 
+                                       self.get_rotation(),
+                                       self.flip_h, self.flip_v) is not None
+
+    # A cheap version of the image rendered at width x height: unlike
+    # get_pixbuf_at_size it's decoded at that size (not to fit in the
+    # screen), and unlike the thumbnails it's only kept in memory:
+    def get_quick_pixbuf_at_size(self, width, height):
+        return self.render_quick_pixbuf(width, height, self.get_rotation(),
+                                        self.flip_h, self.flip_v)
+
+    # The quick pixbuf if it's already in memory, None otherwise:
+    def peek_quick_pixbuf_at_size(self, width, height):
+        return self.render_quick_pixbuf.peek(self, width, height,
+                                             self.get_rotation(),
+                                             self.flip_h, self.flip_v)
+
+    @cached(render_cache)
+    def render_quick_pixbuf(self, width, height, rotation, flip_h, flip_v):
+        if rotation in (90, 270):
+            pixbuf = self.load_at_most(height, width)
+        else:
+            pixbuf = self.load_at_most(width, height)
+
+        return self.transform_pixbuf(pixbuf, width, height,
+                                     rotation, flip_h, flip_v)
+
+    # The embedded preview (see read_exif_preview) rendered as the image
+    # would be, None if the file has no preview:
+    def get_preview_at_size(self, width, height):
+        if not self.is_decoded_from_file():
+            return None
+
+        preview = self.get_embedded_preview()
+        if not preview:
+            return None
+
+        return self.transform_pixbuf(preview, width, height,
+                                     self.get_rotation(), 
+                                     self.flip_h, self.flip_v)
+
+    @cached(pixbuf_cache)
+    def get_embedded_preview(self):
+        data = read_exif_preview(self.get_filename())
+        if not data:
+            return None
+
+        loader = gtk.gdk.PixbufLoader()
+        try:
+            loader.write(data)
+            loader.close()
+        except Exception, e:
+            print "Warning:", e
+            return None
+        return loader.get_pixbuf()
+
+    def transform_pixbuf(self, pixbuf, width, height, rotation, flip_h, flip_v):
         angle_constants = {0: gtk.gdk.PIXBUF_ROTATE_NONE,
                            90: gtk.gdk.PIXBUF_ROTATE_CLOCKWISE,
                            180: gtk.gdk.PIXBUF_ROTATE_UPSIDEDOWN,
                            270: gtk.gdk.PIXBUF_ROTATE_COUNTERCLOCKWISE}
-    
-        pixbuf = self.get_pixbuf()
-        rotated = pixbuf.rotate_simple(angle_constants[self.get_rotation()])
-        scaled = rotated.scale_simple(width, height, gtk.gdk.INTERP_BILINEAR)
-        flipped = scaled.flip(True) if self.flip_h else scaled
-        flipped = flipped.flip(False) if self.flip_v else flipped
+
+        # (the steps with nothing to do are skipped, if all of them are
+        # the pixbuf is shared)
+        rotated = pixbuf
+        if rotation:
+            rotated = pixbuf.rotate_simple(angle_constants[rotation])
+        scaled = rotated
+        if (rotated.get_width(), rotated.get_height()) != (width, height):
+            scaled = rotated.scale_simple(width, height,
+                                          gtk.gdk.INTERP_BILINEAR)
+        flipped = scaled.flip(True) if flip_h else scaled
+        flipped = flipped.flip(False) if flip_v else flipped
 
         return flipped
 
+    def get_thumbnail_at_size(self, width, height):
+        size = self.thumbnail_cache.get_flavor_size(max(width, height))
+
+        if (size is None or not self.persistent_thumbnails or 
+            not self.thumbnail_cache.can_store(self.get_filename())):
+            return self.get_pixbuf_at_size(width, height)
+
+        return self.render_thumbnail(size, width, height, self.rotation,
+                                     self.flip_h, self.flip_v)
+
+    # The thumbnail if it's already in memory, None otherwise:
+    def peek_thumbnail_at_size(self, width, height):
+        size = self.thumbnail_cache.get_flavor_size(max(width, height))
+        if size is None or not self.persistent_thumbnails:
+            return None
+        return self.render_thumbnail.peek(self, size, width, height,
+                                          self.rotation, self.flip_h,
+                                          self.flip_v)
+
+    @cached(render_cache)
+    def render_thumbnail(self, size, width, height, rotation, flip_h, flip_v):
+        # The stored thumbnails already have the EXIF orientation applied:
+        return self.transform_pixbuf(self.get_thumbnail(size), width, height,
+                                     rotation, flip_h, flip_v)
+
+    @cached(pixbuf_cache)
+    def get_thumbnail(self, size):
+        pixbuf = self.thumbnail_cache.load(self.get_filename(), size)
+
+        if not pixbuf:
+            pixbuf = self.build_thumbnail(size)
+            # (the file may be decoded the next time, e.g. if it failed 
+            # because it timed out or a tool is missing)
+            if not is_placeholder(pixbuf):
+                self.thumbnail_cache.save(self.get_filename(), size, pixbuf,
+                                          self.get_original_size())
+
+        return pixbuf
+
+    def build_thumbnail(self, size):
+        width, height = self.get_original_size()
+        if self.get_orientation() in (90, 270):
+            width, height = height, width
+
+        # Thumbnails are never bigger than the original image:
+        factor = min(1.0, float(size) / max(width, height))
+        width = max(1, int(width * factor))
+        height = max(1, int(height * factor))
+
+        pixbuf = self.load_at_most(size, size)
+        if is_placeholder(pixbuf):
+            return pixbuf
+        return self.transform_pixbuf(pixbuf, width, height,
+                                     self.get_orientation(), False, False)
+
+    # Size of the image without any rotation applied (the one of the 
+    # placeholder if the file can't be decoded):
+    @cached()
+    def get_original_size(self):
+        size = self.read_original_size()
+        if size is None:
+            pixbuf = self.get_pixbuf()
+            size = pixbuf.get_width(), pixbuf.get_height()
+        return size
+
+    # None if the file can't be decoded, so the size of the placeholder
+    # isn't persisted (the failure may be transient, e.g. a timeout):
+    @persistent
+    def read_original_size(self):
+        # Try to obtain it from the header of the file, without 
+        # decoding the whole image:
+        try:
+            info = gtk.gdk.pixbuf_get_file_info(self.get_filename())
+        except Exception:
+            info = None
+
+        if info:
+            format_, width, height = info
+            return width, height
+
+        pixbuf = self.get_pixbuf()
+        if is_placeholder(pixbuf):
+            return None
+        return pixbuf.get_width(), pixbuf.get_height()
+
     def get_dimensions(self):
-        width, height = (self.get_pixbuf().get_width(), 
-                         self.get_pixbuf().get_height())
+        width, height = self.get_original_size()
 
         if self.get_rotation() in (90, 270):
             width, height = height, width
@@ -215,16 +658,16 @@ class ImageFile(File):
         return width, height
 
     @cached()
+    @persistent
     def get_tags(self):
-        tags = {}
-        try:
-            image = PILImage.open(self.get_filename())
-            for tag, value in image._getexif().iteritems():
-                decoded = PILExifTags.get(tag, tag)
-                tags[decoded] = value
-        except Exception, e:
-            pass
-        return tags
+        if self.decoder:
+            try:
+                return self.decoder.call(read_tags, self.get_filename())
+            except Cancelled:
+                raise
+            except Exception:
+                pass
+        return read_tags(self.get_filename())
 
     def get_metadata(self):
         tags = self.get_tags()
@@ -246,7 +689,7 @@ class ImageFile(File):
                                 width=1, 
                                 height=1)
         pixbuf.fill(0)
-        return pixbuf
+        return mark_placeholder(pixbuf)
 
 class EmptyImage(ImageFile):
     def __init__(self):
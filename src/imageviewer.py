@@ -1,16 +1,216 @@
 import gtk
+import gobject
 import math
+import itertools
+
+from cache import Cache
+from imagefile import get_pixbuf_size
+
+# Memory budget for the tiles of the zoomed images:
+TILE_CACHE_SIZE = 32 * 1024 * 1024
+
+# Drawing area that can be used like a gtk.Image, but also draws a
+# pixbuf scaled to any size: only the visible tiles are scaled (and 
+# cached, with the ones around them, so panning finds them ready), so
+# the memory needed doesn't depend on the zoom. Should be placed in a
+# gtk.Viewport.
+class TiledImage:
+    TILE_SIZE = 256
+    # Proportion of the tile cache that the tiles prefetched around the
+    # visible area may use (the visible ones must still fit in it):
+    PREFETCH_BUDGET = 0.5
+    # Shared by all the images:
+    tile_cache = Cache(max_bytes=TILE_CACHE_SIZE, sizeof=get_pixbuf_size,
+                       name="tiles")
+    # Identify the tiles of each (source, size) in the cache:
+    serials = itertools.count()
+
+    def __init__(self):
+        self.widget = gtk.DrawingArea()
+        self.widget.connect("expose-event", self.on_expose_event)
+        self.source = None
+        self.width, self.height = 0, 0
+        self.serial = None
+        self.animation_iter = None
+        self.animation_source = None
+        self.prefetch_source = None
+        self.prefetch_tiles = []
+
+    def get_widget(self):
+        return self.widget
+
+    def set_from_pixbuf(self, pixbuf):
+        self.set_from_scaled(pixbuf, pixbuf.get_width(), pixbuf.get_height())
+
+    def set_from_scaled(self, source, width, height):
+        self.stop_animation()
+        self.set_source(source, width, height)
+
+    def set_from_animation(self, animation):
+        self.stop_animation()
+        if animation.is_static_image():
+            self.set_from_pixbuf(animation.get_static_image())
+        else:
+            self.animation_iter = animation.get_iter()
+            self.show_frame()
+
+    def set_source(self, source, width, height):
+        if (source, width, height) != (self.source, self.width, self.height):
+            self.serial = self.serials.next()
+        self.source = source
+        self.width, self.height = width, height
+        self.widget.set_size_request(width, height)
+        self.widget.queue_draw()
+
+    def show_frame(self):
+        frame = self.animation_iter.get_pixbuf()
+        self.set_source(frame, frame.get_width(), frame.get_height())
+
+        delay = self.animation_iter.get_delay_time()
+        if delay >= 0: # (-1 if it's the last frame)
+            self.animation_source = gobject.timeout_add(delay, 
+                                                        self.on_frame_timeout)
+
+    def on_frame_timeout(self):
+        self.animation_source = None
+        self.animation_iter.advance()
+        self.show_frame()
+        return False
+
+    def stop_animation(self):
+        if self.animation_source:
+            gobject.source_remove(self.animation_source)
+            self.animation_source = None
+        self.animation_iter = None
+
+    def is_scaled(self):
+        return ((self.width, self.height) != 
+                (self.source.get_width(), self.source.get_height()))
+
+    # Position of the image in the widget (centered if it's smaller):
+    def get_offset(self):
+        allocation = self.widget.allocation
+        return (max(0, (allocation.width - self.width) / 2),
+                max(0, (allocation.height - self.height) / 2))
+
+    # The (column, row) of the tiles that cover the given area (in 
+    # image coordinates):
+    def get_tiles(self, x, y, width, height):
+        size = self.TILE_SIZE
+        columns = range(max(0, x / size),
+                        min((self.width + size - 1) / size,
+                            (x + width - 1) / size + 1))
+        rows = range(max(0, y / size),
+                     min((self.height + size - 1) / size,
+                         (y + height - 1) / size + 1))
+        return [(column, row) for row in rows for column in columns]
+
+    def get_tile(self, column, row):
+        return self.tile_cache.compute((self.serial, column, row),
+                                       lambda: self.render_tile(column, row))
+
+    def render_tile(self, column, row):
+        x, y = column * self.TILE_SIZE, row * self.TILE_SIZE
+        width = min(self.TILE_SIZE, self.width - x)
+        height = min(self.TILE_SIZE, self.height - y)
+
+        tile = gtk.gdk.Pixbuf(gtk.gdk.COLORSPACE_RGB,
+                              self.source.get_has_alpha(), 8, width, height)
+        self.source.scale(tile, 0, 0, width, height, -x, -y,
+                          float(self.width) / self.source.get_width(),
+                          float(self.height) / self.source.get_height(),
+                          gtk.gdk.INTERP_BILINEAR)
+        return tile
+
+    def on_expose_event(self, widget, event):
+        if not self.source:
+            return False
+
+        offset_x, offset_y = self.get_offset()
+        area = event.area.intersect(gtk.gdk.Rectangle(offset_x, offset_y,
+                                                      self.width, self.height))
+        if area.width <= 0 or area.height <= 0:
+            return False
+
+        if not self.is_scaled():
+            widget.window.draw_pixbuf(None, self.source,
+                                      area.x - offset_x, area.y - offset_y,
+                                      area.x, area.y, area.width, area.height)
+            return False
+
+        # (the drawing is clipped to the exposed area)
+        for column, row in self.get_tiles(area.x - offset_x, 
+                                          area.y - offset_y,
+                                          area.width, area.height):
+            widget.window.draw_pixbuf(None, self.get_tile(column, row), 0, 0,
+                                      offset_x + column * self.TILE_SIZE,
+                                      offset_y + row * self.TILE_SIZE)
+
+        self.schedule_prefetch()
+        return False
+
+    # Makes a single pass over the tiles around the visible area that 
+    # aren't in the cache yet, rendering one of them on each idle call.
+    # At most PREFETCH_BUDGET of the cache is used: otherwise, with big
+    # viewports, the new tiles would evict the ones still to be drawn 
+    # (or the ones rendered before them, in the next pass):
+    def schedule_prefetch(self):
+        viewport = self.widget.get_parent()
+        if not isinstance(viewport, gtk.Viewport):
+            return
+
+        # (the visible area, plus a tile on each side)
+        offset_x, offset_y = self.get_offset()
+        x_adj = viewport.get_hadjustment()
+        y_adj = viewport.get_vadjustment()
+        x = int(x_adj.get_value()) - offset_x - self.TILE_SIZE
+        y = int(y_adj.get_value()) - offset_y - self.TILE_SIZE
+        width = int(x_adj.get_page_size()) + 2 * self.TILE_SIZE
+        height = int(y_adj.get_page_size()) + 2 * self.TILE_SIZE
+
+        tile_bytes = self.TILE_SIZE * self.TILE_SIZE * 4
+        max_tiles = int(self.tile_cache.max_bytes * 
+                        self.PREFETCH_BUDGET) / tile_bytes
+        self.prefetch_tiles = [
+            (self.serial, column, row)
+            for column, row in self.get_tiles(x, y, width, height)
+            if self.tile_cache.peek((self.serial, column, row)) is None
+        ][:max_tiles]
+
+        if self.prefetch_tiles and not self.prefetch_source:
+            self.prefetch_source = gobject.idle_add(self.prefetch_tile)
+
+    # Renders the next tile to prefetch, returns False when there are no
+    # more (or the image changed):
+    def prefetch_tile(self):
+        while self.prefetch_tiles:
+            serial, column, row = self.prefetch_tiles.pop(0)
+            if (self.source and serial == self.serial and
+                self.tile_cache.peek((serial, column, row)) is None):
+                self.get_tile(column, row)
+                return True
+
+        self.prefetch_source = None
+        return False
 
 class ImageViewer:
     def __init__(self):
-        self.widget = gtk.Image()
+        self.image, self.widget = self.create_image()
         self.zoom_factor = 100
         self.image_file = None
         self.size = (1, 1)
 
+    def create_image(self):
+        image = TiledImage()
+        return image, image.get_widget()
+
     def get_widget(self):
         return self.widget
 
+    # Draws a pixbuf (e.g. a preview of the image) instead of the image:
+    def draw_pixbuf(self, pixbuf):
+        self.image.set_from_pixbuf(pixbuf)
+
     def get_zoom_factor(self):
         return self.zoom_factor
 
@@ -72,13 +272,24 @@ class ImageViewer:
 
     def redraw(self):
         width, height = self.get_scaled_size()
-        self.image_file.draw(self.widget, width, height)
+        self.image_file.draw(self.image, width, height)
 
     def force_zoom(self, width, height):
-        im_dim = self.image_file.get_dimensions()
+        self.set_zoom_factor(self.get_zoom_to_fit(self.image_file, 
+                                                  width, height))
+
+    def get_zoom_to_fit(self, image_file, width, height):
+        im_dim = image_file.get_dimensions()
         zw = (float(width) / im_dim.get_width()) * 99
         zh = (float(height) / im_dim.get_height()) * 99
-        self.set_zoom_factor(min(zw, zh))
+        return min(zw, zh)
+
+    # Size at which a file would be drawn to fit in width x height:
+    def get_size_to_fit(self, image_file, width, height):
+        zoom_factor = self.get_zoom_to_fit(image_file, width, height)
+        dimensions = image_file.get_dimensions()
+        return (int((dimensions.get_width() * zoom_factor) / 100),
+                int((dimensions.get_height() * zoom_factor) / 100))
 
 class ThumbnailViewer(ImageViewer):
     def __init__(self, th_size):
@@ -86,6 +297,11 @@ class ThumbnailViewer(ImageViewer):
         self.th_size = th_size
         self.hidden = False
 
+    def create_image(self):
+        # (the thumbnails are small, a gtk.Image is enough)
+        image = gtk.Image()
+        return image, image
+
     def set_size(self, size):
         self.th_size = size
         self.widget.set_size_request(self.th_size, self.th_size)
@@ -111,7 +327,7 @@ class ThumbnailViewer(ImageViewer):
         width = int(math.ceil((dimensions.get_width() * self.zoom_factor) / 100))
         height = int(math.ceil((dimensions.get_height() * self.zoom_factor) / 100))
 
-        self.widget.set_from_pixbuf(self.image_file.get_pixbuf_at_size(width, height))
+        self.widget.set_from_pixbuf(self.image_file.get_thumbnail_at_size(width, height))
 
     def fill(self):
         pixbuf = gtk.gdk.Pixbuf(colorspace=gtk.gdk.COLORSPACE_RGB, 
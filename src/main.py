@@ -1,10 +1,14 @@
 import os
+import json
 import optparse
 
 from collections import defaultdict
 
 from filefactory import FileFactory
+from cache import get_stats
 from filescanner import FileScanner
+from imagefile import ImageFile
+from decoder import DecoderPool
 from viewerapp import ViewerApp
 
 def check_directories(args):
@@ -33,9 +37,24 @@ def main():
     parser.add_option("-c", "--check", action="store_true", default=False)
     parser.add_option("-s", "--stats", action="store_true", default=False)
     parser.add_option("-b", "--base-dir")
+    parser.add_option("-m", "--cache-size", type="int", metavar="MB",
+                      help="memory budget for decoded images")
+    parser.add_option("--cache-stats", action="store_true", default=False,
+                      help="print the cache statistics (JSON) on exit")
+    parser.add_option("-d", "--decode-processes", type="int", metavar="N",
+                      help="decode the images in N processes")
+    parser.add_option("--cache-trace", metavar="FILE",
+                      help="record the accesses to the image cache "
+                           "(see benchmark.py)")
 
     options, args = parser.parse_args()
 
+    if options.cache_size is not None:
+        ImageFile.pixbuf_cache.set_max_bytes(options.cache_size * 1024 * 1024)
+
+    if options.cache_trace:
+        ImageFile.pixbuf_cache.set_trace_file(open(options.cache_trace, "w"))
+
     if not args:
         args = ["."]
 
@@ -50,6 +69,9 @@ def main():
         print_stats(files)
         return
 
+    if options.decode_processes:
+        ImageFile.decoder = DecoderPool(options.decode_processes)
+
     try:
         app = ViewerApp(files, start_file, options.base_dir)
         app.run()
@@ -58,5 +80,11 @@ def main():
         traceback.print_exc()
         print "Error:", e
 
+    if ImageFile.decoder:
+        ImageFile.decoder.stop()
+
+    if options.cache_stats:
+        print json.dumps(get_stats(), indent=4, sort_keys=True)
+
 if __name__ == "__main__":
     main()
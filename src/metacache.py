@@ -0,0 +1,136 @@
+# Persistent cache of per-file metadata (checksums, dimensions, tags,
+# durations, listings...) that is expensive to obtain. The entries are
+# keyed by path and validated with the size and mtime of the file.
+import os
+import stat as stat_
+import sqlite3
+import cPickle
+
+from threading import Lock
+from functools import wraps
+
+def get_database_path():
+    cache_dir = os.getenv("XDG_CACHE_HOME")
+    if not cache_dir:
+        cache_dir = os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(cache_dir, "gtk-viewer", "metadata.db")
+
+class MetadataCache:
+    def __init__(self, path=None):
+        self.path = path if path else get_database_path()
+        self.lock = Lock()
+        self.connection = None
+        self.enabled = True
+
+    def connect(self):
+        if self.connection:
+            return self.connection
+
+        directory = os.path.dirname(self.path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory, 0700)
+
+        # The connection is shared by all the threads (access is
+        # serialized with self.lock). It's just a cache, so durability
+        # is traded for speed:
+        connection = sqlite3.connect(self.path, check_same_thread=False)
+        connection.execute("PRAGMA journal_mode = WAL")
+        connection.execute("PRAGMA synchronous = OFF")
+        connection.execute("CREATE TABLE IF NOT EXISTS metadata ("
+                           "path TEXT, key TEXT, size INTEGER, mtime REAL, "
+                           "value BLOB, PRIMARY KEY (path, key))")
+        connection.commit()
+        self.connection = connection
+        return connection
+
+    def disable(self, error):
+        print "Warning: metadata cache disabled:", error
+        self.enabled = False
+
+    def get(self, path, key, size, mtime):
+        with self.lock:
+            if not self.enabled:
+                return None
+            try:
+                row = self.connect().execute(
+                    "SELECT size, mtime, value FROM metadata "
+                    "WHERE path = ? AND key = ?", (path, key)).fetchone()
+            except Exception, e:
+                self.disable(e)
+                return None
+
+        if not row or row[0] != size or row[1] != mtime:
+            return None
+
+        try:
+            return (cPickle.loads(str(row[2])),)
+        except Exception, e:
+            # Corrupt (or stored by an incompatible version), it's just
+            # a miss:
+            print "Warning: discarding cached %s of '%s': %s" % (key, path, e)
+            self.delete(path, key)
+            return None
+
+    def delete(self, path, key):
+        with self.lock:
+            if not self.enabled:
+                return
+            try:
+                connection = self.connect()
+                connection.execute("DELETE FROM metadata "
+                                   "WHERE path = ? AND key = ?", (path, key))
+                connection.commit()
+            except Exception, e:
+                self.disable(e)
+
+    def set(self, path, key, size, mtime, value):
+        try:
+            data = cPickle.dumps(value, cPickle.HIGHEST_PROTOCOL)
+        except Exception:
+            return # not everything can be stored
+
+        with self.lock:
+            if not self.enabled:
+                return
+            try:
+                connection = self.connect()
+                connection.execute("INSERT OR REPLACE INTO metadata "
+                                   "VALUES (?, ?, ?, ?, ?)",
+                                   (path, key, size, mtime,
+                                    sqlite3.Binary(data)))
+                connection.commit()
+            except Exception, e:
+                self.disable(e)
+
+metadata_cache = MetadataCache()
+
+# Decorator for methods of objects with a 'filename' attribute, the
+# result is stored in the metadata cache. Should be used below @cached,
+# so the database is only checked once per instance:
+def persistent(method):
+    # (the name is preserved because @cached uses it in the key)
+    @wraps(method)
+    def wrapper(self, *args):
+        try:
+            path = os.path.abspath(self.filename)
+            stat = os.stat(path)
+        except Exception:
+            stat = None
+
+        # Only regular files are persisted:
+        if not self.filename or not stat or not stat_.S_ISREG(stat.st_mode):
+            return method(self, *args)
+
+        key = "%s.%s%s" % (self.__class__.__name__, method.__name__,
+                           repr(args))
+
+        found = metadata_cache.get(path, key, stat.st_size, stat.st_mtime)
+        if found:
+            return found[0]
+
+        # (None means that the value couldn't be obtained this time)
+        value = method(self, *args)
+        if value is not None:
+            metadata_cache.set(path, key, stat.st_size, stat.st_mtime, value)
+        return value
+    return wrapper
@@ -2,20 +2,26 @@ import os
 import glob
 import string
 import tempfile
-import pexpect
 
 import gtk
 
-from imagefile import ImageFile, GTKIconImage
-from cache import Cache, cached
-from system import execute
+from imagefile import ImageFile, GTKIconImage, mark_placeholder
+from cache import cached
+from metacache import persistent
+from system import execute, stream
+from cancellation import Cancelled
+from threads import Lane
 
 class PDFFile(ImageFile):
     description = "pdf"
     valid_extensions = ["pdf"]
-    pixbuf_cache = Cache(10)
+    # The images are extracted by pdfimages:
+    lane = Lane.IO
+    # Maximum time (in seconds) to extract the preview:
+    PREVIEW_TIMEOUT = 60
 
     @cached()
+    @persistent
     def get_metadata(self):
         info = [("Property", "Value")]
         output = execute(["pdfinfo", self.get_filename()], check_retcode=False)
@@ -31,12 +37,21 @@ class PDFFile(ImageFile):
         except KeyError:
             return 0
 
-    @cached(pixbuf_cache)
+    @cached(ImageFile.pixbuf_cache)
     def get_pixbuf(self):
         tmp_root = os.path.join(tempfile.gettempdir(), "%s" % self.get_basename())
-        execute(["pdfimages", "-f", "1", "-l", "1", "-j", 
-                 self.get_filename(), 
-                 tmp_root])
+        try:
+            execute(["pdfimages", "-f", "1", "-l", "1", "-j", 
+                     self.get_filename(), 
+                     tmp_root], timeout=self.PREVIEW_TIMEOUT)
+        except Cancelled:
+            raise
+        except Exception, e:
+            # (e.g. it timed out, or pdfimages isn't installed; an image
+            # may have been left half written)
+            print "Warning:", e
+            for filename in glob.glob(tmp_root + "*"):
+                os.unlink(filename)
 
         for ext in ["jpg", "pbm", "ppm"]:
             try:
@@ -49,24 +64,36 @@ class PDFFile(ImageFile):
                 continue
 
         print "Warning: unable to preview PDF file '%s'" % self.get_basename()
-        return GTKIconImage(gtk.STOCK_MISSING_IMAGE, 256).get_pixbuf()
+        icon = GTKIconImage(gtk.STOCK_MISSING_IMAGE, 256).get_pixbuf()
+        return mark_placeholder(icon.copy())
 
     def get_sha1(self):
         # avoiding this for PDF files
         return "Pages: %d" % (self.get_pages())
 
+    # Number of images in the file (None if pdfimages can't list them):
+    def get_images_count(self):
+        output = execute(["pdfimages", "-list", self.get_filename()],
+                         check_retcode=False)
+        lines = output.splitlines()
+        if not lines or not lines[0].startswith("page"):
+            return None
+        # (two header lines)
+        return len(lines) - 2
+
     def extract_contents(self, tmp_dir):
         try:
             tmp_root = os.path.join(tmp_dir, "%s" % self.get_basename())
-            child = pexpect.spawn("pdfimages", ["-j", self.get_filename(), tmp_root])
-            while True:
-                try:
-                    child.expect("", 0.1)
-                except pexpect.TIMEOUT:
-                    pass
-                yield None
-        except pexpect.EOF:
-            pass
+            images = self.get_images_count()
+
+            written = 0
+            for line in stream(["pdfimages", "-j", "-print-filenames",
+                                self.get_filename(), tmp_root]):
+                # Progress lines: the name of each image written (the 
+                # warnings are in the output too)
+                if line.startswith(tmp_root):
+                    written += 1
+                    yield min(1.0, float(written) / images) if images else None
         except Exception, e:
             print "Warning:", e
 
@@ -76,17 +103,10 @@ class PDFFile(ImageFile):
 class PDFGenerator:
     def generate(self, files, output):
         try:
-            child = pexpect.spawn("convert", ["-verbose"] +
-                                              files + 
-                                              [output])
-            while True:
-                try:
-                    child.expect("\=\>" + output, 0.1)
-                except pexpect.TIMEOUT:
-                    pass
+            for line in stream(["convert", "-verbose"] +
+                               files + 
+                               [output]):
                 yield None
-        except pexpect.EOF:
-            pass
         except Exception, e:
             print "Warning:", e
 
@@ -1,16 +1,180 @@
 import os
+import re
+import pty
 import glob
+import errno
 import shutil
 import subprocess
 
+from threading import Condition, Timer
+from contextlib import contextmanager
+from multiprocessing import cpu_count
+
 import gio
 
-def execute(args, check_retcode=True):
-    popen = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    stdout, stderr = popen.communicate()
-    if check_retcode and popen.returncode != 0:
-        raise Exception(str(args) + " failed!")
-    return stdout + stderr
+from cancellation import get_current_token, check_cancelled
+
+class ProcessTimeout(Exception):
+    pass
+
+def kill_process(popen):
+    try:
+        popen.kill()
+    except OSError:
+        pass # already finished
+
+# Splits the output in lines as it arrives (the progress of many tools
+# is updated with '\r'):
+def read_lines(fd):
+    buffer_ = ""
+    while True:
+        try:
+            data = os.read(fd, 4096)
+        except OSError, e:
+            if e.errno != errno.EIO:
+                raise
+            data = "" # the other end of the pty was closed
+        if not data:
+            break
+        lines = re.split("\r\n|\r|\n", buffer_ + data)
+        buffer_ = lines.pop()
+        for line in lines:
+            if line:
+                yield line
+    if buffer_:
+        yield buffer_
+
+# Runs the external tools (avconv, convert, pdfimages, unzip...), at most
+# max_processes at the same time. The processes are killed when the job
+# running them is cancelled, or when the timeout (in seconds) expires.
+class ProcessRunner:
+    def __init__(self, max_processes):
+        self.max_processes = max_processes
+        self.running = 0
+        self.cond = Condition()
+
+    def acquire(self):
+        # Wake up if the job is cancelled while waiting:
+        token = get_current_token()
+        wake = lambda: self.notify()
+        if token:
+            token.add_callback(wake)
+        try:
+            with self.cond:
+                while self.running >= self.max_processes:
+                    check_cancelled()
+                    self.cond.wait()
+                self.running += 1
+        finally:
+            if token:
+                token.remove_callback(wake)
+
+    def release(self):
+        with self.cond:
+            self.running -= 1
+            self.cond.notify_all()
+
+    def notify(self):
+        with self.cond:
+            self.cond.notify_all()
+
+    @contextmanager
+    def process(self, args, timeout=None, bounded=True, **kwargs):
+        if bounded:
+            self.acquire()
+        try:
+            # (the descriptors of the processes started by other threads
+            # are not inherited, otherwise their pipes wouldn't be closed)
+            popen = subprocess.Popen(args, close_fds=True, **kwargs)
+            timed_out = []
+            kill = lambda: kill_process(popen)
+            def expire():
+                timed_out.append(True)
+                kill()
+
+            token = get_current_token()
+            if token:
+                token.add_callback(kill)
+            timer = Timer(timeout, expire) if timeout else None
+            if timer:
+                timer.daemon = True
+                timer.start()
+
+            try:
+                yield popen
+            finally:
+                if timer:
+                    timer.cancel()
+                if token:
+                    token.remove_callback(kill)
+                if popen.poll() is None:
+                    kill()
+                    popen.wait()
+
+            check_cancelled()
+            if timed_out:
+                raise ProcessTimeout("%s timed out" % str(args))
+        finally:
+            if bounded:
+                self.release()
+
+    # Returns the output (stdout and then stderr) when the process ends.
+    # Processes that are not bounded don't wait for (nor take) a slot:
+    def execute(self, args, check_retcode=True, timeout=None, bounded=True):
+        with self.process(args, timeout, bounded, 
+                          stdout=subprocess.PIPE, 
+                          stderr=subprocess.PIPE) as popen:
+            stdout, stderr = popen.communicate()
+
+        if check_retcode and popen.returncode != 0:
+            raise Exception(str(args) + " failed!")
+        return stdout + stderr
+
+    # Generates the lines of the output (stdout and stderr) as they are 
+    # written. Some tools only flush their output line by line when it's
+    # a terminal, use_pty runs them in a pseudo-terminal:
+    def stream(self, args, check_retcode=True, timeout=None, cwd=None, 
+                     use_pty=False):
+        if use_pty:
+            master, slave = pty.openpty()
+            kwargs = {"stdout" : slave, "stderr" : slave}
+        else:
+            kwargs = {"stdout" : subprocess.PIPE, "stderr" : subprocess.STDOUT}
+
+        try:
+            with self.process(args, timeout, cwd=cwd, **kwargs) as popen:
+                if use_pty:
+                    os.close(slave)
+                    slave = None
+                    fd = master
+                else:
+                    fd = popen.stdout.fileno()
+
+                for line in read_lines(fd):
+                    yield line
+                popen.wait()
+        finally:
+            if use_pty:
+                os.close(master)
+                if slave is not None:
+                    os.close(slave)
+
+        if check_retcode and popen.returncode != 0:
+            raise Exception(str(args) + " failed!")
+
+def get_max_processes():
+    try:
+        return max(2, cpu_count())
+    except NotImplementedError:
+        return 2
+
+runner = ProcessRunner(get_max_processes())
+
+def execute(args, check_retcode=True, timeout=None, bounded=True):
+    return runner.execute(args, check_retcode, timeout, bounded)
+
+def stream(args, check_retcode=True, timeout=None, cwd=None, use_pty=False):
+    return runner.stream(args, check_retcode, timeout, cwd, use_pty)
 
 ### Multi-platform functions:        
 def os_switch(functions):
@@ -48,17 +212,17 @@ def untrash(filename):
 
 ### Mac OS X specific functions:
 def external_open_macosx(filename):
-    execute(["open", filename])
+    execute(["open", filename], bounded=False)
 
 def get_process_memory_usage_macosx(pid):
-    output = execute(["ps", "-v", "-p", str(pid)])
+    output = execute(["ps", "-v", "-p", str(pid)], bounded=False)
     lines = output.split('\n')
     rss, vsize = filter(lambda x:x, lines[1].split(' '))[6:8]
     return (int(rss) * 1024, int(vsize) * 1024)
 
 ### Linux specific functions:
 def external_open_linux(filename):
-    execute(["xdg-open", filename])
+    execute(["xdg-open", filename], bounded=False)
 
 def get_process_memory_usage_linux(pid, pagesize):
     with open("/proc/%i/stat" % pid) as statfile:
@@ -1,7 +1,12 @@
+import os
 import time
 import gobject
 
 from threading import Thread, Lock, Condition
+from collections import deque
+from multiprocessing import cpu_count
+
+from cancellation import Cancelled, CancellationToken, set_current_token
 
 # Run this once during application start:
 gobject.threads_init()
@@ -10,77 +15,312 @@ gobject.threads_init()
 def yield_processor():
     time.sleep(0.000001)
 
-# Use this thread to postpone work and update the GUI asynchronously.
-# The idea is to push a function and some parameters, and that function
-# will be executed in a separate thread. This function must NOT update
-# the UI directly, it must return another function with its own arguments
-# to be queued in the main thread's event loop with gobject.idle_add. 
-# (See http://faq.pygtk.org/index.py?file=faq20.006.htp&req=show)
-class Worker(Thread):
-    def __init__(self):
-        Thread.__init__(self)
+# Priority classes of the jobs (the lower, the sooner they run):
+class Priority:
+    CURRENT = 0     # the image being viewed, the operations the user 
+                    # waits for (filters, mass operations...)
+    NEIGHBOURS = 1  # the thumbnails of the previous and next images
+    PREFETCH = 2    # images likely to be viewed soon
+    GALLERY = 3     # the thumbnails of the galleries
+    BACKGROUND = 4  # anything else
+    LEVELS = 5
+
+def get_cpu_count():
+    try:
+        return cpu_count()
+    except NotImplementedError:
+        return 2
+
+# Threads shared by all the subsystems. The jobs are run by priority (and
+# in the order they were submitted for the same priority), so the image
+# being viewed doesn't wait behind the thumbnails of a gallery:
+class ThreadPool:
+    def __init__(self, size):
+        self.size = size
         self.lock = Lock()
         self.cond = Condition(self.lock)
-        self.stopped = False
-        self.queue = []
+        # A FIFO queue per priority, so queueing and dequeuing are 
+        # constant time:
+        self.queues = [deque() for level in range(Priority.LEVELS)]
+        self.queued = 0
+        self.threads = 0
+
+    def resize(self, size):
+        with self.cond:
+            self.size = size
+            # (the extra threads exit when they wake up)
+            self.cond.notify_all()
+
+    def submit(self, priority, job):
+        with self.cond:
+            # The threads are started on first use:
+            while self.threads < self.size:
+                thread = Thread(target=self.run)
+                thread.daemon = True
+                thread.start()
+                self.threads += 1
+
+            self.queues[priority].append(job)
+            self.queued += 1
+            self.cond.notify()
+
+    def get_job(self):
+        for queue in self.queues:
+            if queue:
+                self.queued -= 1
+                return queue.popleft()
 
     def run(self):
         while True:
-            job = None
             with self.cond:
-                if self.stopped:
-                    return
-                if not self.queue:
+                while not self.queued and self.threads <= self.size:
                     self.cond.wait()
-                else:
-                    job, params = self.queue.pop(0)
-            if not job:
-                continue
-            self.execute(job, params)
+                if self.threads > self.size:
+                    self.threads -= 1
+                    return
+                job = self.get_job()
+
+            try:
+                job()
+            except Exception, e:
+                print "Warning:", e
+            self.on_job_done()
+
+    def on_job_done(self):
+        pass
+
+# Pool for the jobs that mostly wait for external processes or I/O. Its 
+# size is tuned from the CPU time used by the external processes: if they
+# keep all the cores busy, it's limited to one thread per core, otherwise
+# it grows (up to max_size) to keep them busy. It never goes below two
+# threads, so a long operation (e.g. an extraction) doesn't hold it all.
+class IOThreadPool(ThreadPool):
+    # Number of jobs between adjustments:
+    SAMPLE_JOBS = 16
+    # Proportion of the cores used to consider them all busy:
+    BUSY_CORES = 0.9
+
+    def __init__(self, cpus):
+        self.cpus = cpus
+        self.min_size = max(2, cpus)
+        self.max_size = 4 * cpus
+        ThreadPool.__init__(self, max(self.min_size, 2 * cpus))
+        self.sample_lock = Lock()
+        self.reset_sample()
+
+    def reset_sample(self):
+        self.sample_jobs = 0
+        self.sample_start = time.time()
+        self.sample_cpu_time = self.get_children_cpu_time()
+
+    def get_children_cpu_time(self):
+        times = os.times()
+        return times[2] + times[3]
+
+    def on_job_done(self):
+        with self.sample_lock:
+            self.sample_jobs += 1
+            if self.sample_jobs < self.SAMPLE_JOBS:
+                return
+
+            # Average number of cores used by the external processes:
+            cpu_time = self.get_children_cpu_time() - self.sample_cpu_time
+            cores = cpu_time / max(time.time() - self.sample_start, 0.001)
+            self.reset_sample()
+
+        if cores >= self.BUSY_CORES * self.cpus:
+            size = self.min_size
+        elif cores > 0:
+            size = int(self.size * self.cpus / cores)
+        else:
+            size = self.max_size
+        self.resize(min(max(size, self.min_size), self.max_size))
+
+# Kind of resources used by the jobs:
+class Lane:
+    CPU = "cpu" # decoding and scaling in this process
+    IO = "io"   # external processes, disk and network
+
+# (at least two threads in the CPU lane, so a long decode doesn't block 
+# the image being viewed on single core machines)
+lanes = {Lane.CPU : ThreadPool(max(2, get_cpu_count())),
+         Lane.IO : IOThreadPool(get_cpu_count())}
+
+# Use this to postpone work and update the GUI asynchronously. The idea
+# is to push a function and some parameters, and that function will be
+# executed in a thread of the pool. This function must NOT update the UI
+# directly, it must return another function with its own arguments to
+# be queued in the main thread's event loop with gobject.idle_add. 
+# (See http://faq.pygtk.org/index.py?file=faq20.006.htp&req=show)
+# Running jobs are cancelled (see cancellation.py) when the worker is
+# cleared or stopped, or when a job with the same key is pushed. The
+# result of a cancelled job is discarded.
+class Worker:
+    def __init__(self, priority=Priority.BACKGROUND, lane=Lane.CPU):
+        self.priority = priority
+        self.lane = lane
+        self.lock = Lock()
+        self.cond = Condition(self.lock)
+        self.stopped = False
+        # Jobs pushed before the last clear() are discarded when the 
+        # pool gets to them:
+        self.generation = 0
+        self.running = 0
+        # Queued jobs by key (see push):
+        self.pending = {}
+        # Keys of the running jobs, by token:
+        self.tokens = {}
+
+    def run_job(self, generation, job, key, ticket):
+        token = CancellationToken()
+        with self.cond:
+            if self.stopped or generation != self.generation:
+                return
+            if key is not None:
+                # (skipped if the job was moved to another lane)
+                queued = self.pending.get(key)
+                if not queued or queued[2] is not ticket:
+                    return
+                job = self.pending.pop(key)[0]
+            self.running += 1
+            self.tokens[token] = key
+
+        set_current_token(token)
+        try:
+            self.execute(token, *job)
+        finally:
+            set_current_token(None)
+            with self.cond:
+                del self.tokens[token]
+                self.running -= 1
+                self.cond.notify_all()
 
-    def execute(self, job, params):
+    def execute(self, token, job, params):
         try:
             func, args = job(*params)
             # The async function may decide to NOT update
             # the UI:
-            if func:
+            if func and not token.is_cancelled():
                 gobject.idle_add(func, *args)
+        except Cancelled:
+            pass
         except Exception, e:
             print "Warning:", e
 
+    def cancel(self, key=None):
+        # Cancel the running jobs (all of them if no key is given):
+        with self.cond:
+            tokens = [token for token, token_key in self.tokens.items()
+                      if key is None or token_key == key]
+        for token in tokens:
+            token.cancel()
+
+    # Cancels the job with the given key, also if it's still queued (its
+    # ticket is dropped, so the pool skips it when it gets to it):
+    def discard(self, key):
+        with self.cond:
+            self.pending.pop(key, None)
+        self.cancel(key)
+
     def stop(self):
         with self.cond:
             self.stopped = True
-            self.cond.notify_all()
+            self.generation += 1
+            self.pending = {}
+        self.cancel()
+
+    def join(self):
+        # Wait for the jobs already running:
+        with self.cond:
+            while self.running:
+                self.cond.wait()
 
     def clear(self):
         with self.cond:
-            self.queue = []
-            self.cond.notify_all()
+            self.generation += 1
+            self.pending = {}
+        self.cancel()
 
-    def push(self, job):
+    # If a key is given, and a job with the same key is still queued, 
+    # the new job replaces it (keeping its place in the queue if it goes
+    # to the same lane). The lane defaults to the one of the worker:
+    def push(self, job, key=None, lane=None):
+        if key is not None:
+            self.cancel(key)
+
+        lane = lane or self.lane
+        ticket = None
         with self.cond:
-            self.queue.append(job)
-            self.cond.notify_all()
+            if self.stopped:
+                return
+            if key is not None:
+                # Queued jobs are (job, lane, ticket), the ticket tells 
+                # which submission runs it:
+                queued = self.pending.get(key)
+                if queued and queued[1] == lane:
+                    self.pending[key] = (job, lane, queued[2])
+                    return
+                ticket = object()
+                self.pending[key] = (job, lane, ticket)
+            generation = self.generation
+        lanes[lane].submit(self.priority, 
+                           lambda: self.run_job(generation, job, key, ticket))
+
+# Consumes a generator in the pool, reporting its progress and its end
+# in the main thread. The progress is delivered at most 
+# MAX_UPDATES_PER_SECOND times per second (always the latest value), so 
+# generators yielding very often don't flood the main loop. The user is
+# usually waiting for them (in a modal dialog), so they are run ahead of
+# the prefetching and the galleries by default:
+class Updater:
+    MAX_UPDATES_PER_SECOND = 20
 
-class Updater(Thread):
-    def __init__(self, generator, on_progress, on_finish, on_finish_args):
-        Thread.__init__(self)
+    def __init__(self, generator, on_progress, on_finish, on_finish_args,
+                       priority=Priority.CURRENT, lane=Lane.IO):
+        self.priority = priority
+        self.lane = lane
         self.generator = generator
         self.on_progress = on_progress
         self.on_finish = on_finish
         self.on_finish_args = on_finish_args
 
+        self.lock = Lock()
+        self.progress = None
+        self.scheduled = False
+        self.last_update = 0
+        self.finished = False
+
+    def start(self):
+        lanes[self.lane].submit(self.priority, self.run)
+
+    def set_progress(self, progress):
+        with self.lock:
+            self.progress = progress
+            if self.scheduled:
+                return # the pending update will deliver this value
+            self.scheduled = True
+            delay = (self.last_update + 1.0 / self.MAX_UPDATES_PER_SECOND - 
+                     time.time())
+        gobject.timeout_add(max(0, int(delay * 1000)), self.update)
+
+    # These are run in the main thread:
+    def update(self):
+        with self.lock:
+            progress = self.progress
+            self.scheduled = False
+            self.last_update = time.time()
+        if not self.finished:
+            self.on_progress(progress)
+        return False
+
+    def finish(self):
+        self.finished = True
+        self.on_finish(*self.on_finish_args)
+
     def run(self):
         try:
             for progress in self.generator:
-                gobject.idle_add(self.on_progress, progress)
-                # give a chance to the main thread to update the 
-                # progressbar: (otherwise, if there are no IO
-                # operations while the generator is consumed,
-                # the main thread is never run and the UI just 
-                # blocks)
-                yield_processor()
+                self.set_progress(progress)
         except Exception, e:
             print "Warning", e
 
@@ -88,9 +328,4 @@ class Updater(Thread):
         # probable that it will try to modify the UI). If we
         # run it here, many GTK assertions will fail and even
         # SIGSEGVs may be generated
-        gobject.idle_add(self.on_finish, *self.on_finish_args)
-
-        # Trick to "auto" dispose the thread: (if the on_finish 
-        # callback tried to join this thread, it would deadlock)
-        gobject.idle_add(lambda t: t.join(), self)
-
+        gobject.idle_add(self.finish)
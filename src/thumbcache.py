@@ -0,0 +1,93 @@
+# Persistent thumbnails, stored following the freedesktop.org thumbnail
+# spec (http://specifications.freedesktop.org/thumbnail-spec/), so the
+# thumbnails generated by other applications are reused (and vice versa)
+import os
+import hashlib
+import tempfile
+
+import gtk
+import gio
+
+def get_thumbnails_dir():
+    cache_dir = os.getenv("XDG_CACHE_HOME")
+    if not cache_dir:
+        cache_dir = os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(cache_dir, "thumbnails")
+
+class ThumbnailCache:
+    # Thumbnail sizes defined by the spec, (directory, maximum size):
+    FLAVORS = [("normal", 128),
+               ("large", 256),
+               ("x-large", 512),
+               ("xx-large", 1024)]
+
+    def __init__(self, root=None):
+        self.root = root if root else get_thumbnails_dir()
+
+    def get_flavor_size(self, size):
+        for flavor, flavor_size in self.FLAVORS:
+            if size <= flavor_size:
+                return flavor_size
+        return None
+
+    def get_flavor(self, size):
+        return dict((flavor_size, flavor)
+                    for flavor, flavor_size in self.FLAVORS)[size]
+
+    def get_uri(self, filename):
+        # The URI must be escaped exactly as other applications do it:
+        return gio.File(path=os.path.abspath(filename)).get_uri()
+
+    def get_path(self, filename, size):
+        digest = hashlib.md5(self.get_uri(filename)).hexdigest()
+        return os.path.join(self.root, self.get_flavor(size), digest + ".png")
+
+    def can_store(self, filename):
+        # Thumbnails of thumbnails must not be generated:
+        return (filename and
+                not os.path.abspath(filename).startswith(self.root))
+
+    def load(self, filename, size):
+        try:
+            pixbuf = gtk.gdk.pixbuf_new_from_file(self.get_path(filename, size))
+        except Exception:
+            return None
+
+        # Discard it if the file was modified after the thumbnail was
+        # generated:
+        try:
+            mtime = int(os.stat(filename).st_mtime)
+            if (pixbuf.get_option("tEXt::Thumb::URI") != self.get_uri(filename) or
+                int(pixbuf.get_option("tEXt::Thumb::MTime")) != mtime):
+                return None
+        except Exception:
+            return None
+
+        return pixbuf
+
+    def save(self, filename, size, pixbuf, original_size):
+        path = self.get_path(filename, size)
+        directory = os.path.dirname(path)
+        tmp_path = None
+
+        try:
+            if not os.path.isdir(directory):
+                os.makedirs(directory, 0700)
+
+            options = {"tEXt::Thumb::URI" : self.get_uri(filename),
+                       "tEXt::Thumb::MTime" : str(int(os.stat(filename).st_mtime)),
+                       "tEXt::Thumb::Size" : str(os.stat(filename).st_size),
+                       "tEXt::Thumb::Image::Width" : str(original_size[0]),
+                       "tEXt::Thumb::Image::Height" : str(original_size[1]),
+                       "tEXt::Software" : "gtk-viewer"}
+
+            # Write a temporary file (created with 0600 permissions) and
+            # rename it, so other processes never see a partial thumbnail:
+            fd, tmp_path = tempfile.mkstemp(suffix=".png", dir=directory)
+            os.close(fd)
+            pixbuf.save(tmp_path, "png", options)
+            os.rename(tmp_path, path)
+        except Exception, e:
+            print "Warning: unable to save thumbnail for '%s': %s" % (filename, e)
+            if tmp_path and os.path.isfile(tmp_path):
+                os.unlink(tmp_path)
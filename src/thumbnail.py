@@ -1,20 +1,45 @@
 import gtk
 
-from imagefile import ImageFile, GTKIconImage
+from imagefile import ImageFile, GTKIconImage, get_pixbuf_size
 from filescanner import FileScanner
 from filemanager import FileManager
 
-from cache import Cache, cached
+from cache import DirectoryCache, cached
+from threads import Lane
 
 class DirectoryThumbnail(ImageFile):
-    cache = Cache(top_cache=FileScanner.cache)
+    cache = DirectoryCache(path_func=lambda key: key[1], 
+                           max_bytes=64 * 1024 * 1024,
+                           sizeof=get_pixbuf_size,
+                           top_cache=FileScanner.cache,
+                           name="directory thumbnails")
     default_thumbnail_size = 512
+    # Building the mosaic decodes thumbnails in this process (the I/O
+    # lane is sized by the CPU used by the child processes):
+    lane = Lane.CPU
     default_gtk_icon_size = 128
 
     def __init__(self, directory):
         ImageFile.__init__(self, "")
         self.directory = directory
 
+    # (the per-instance caches are keyed by hash)
+    def __hash__(self):
+        return hash(self.directory)
+
+    # The renders are not cached in the shared pixbuf cache, which isn't
+    # invalidated when the directory changes (they are small and cheap
+    # to regenerate from get_pixbuf, which is in the directory cache):
+    def get_pixbuf_at_size(self, width, height):
+        return self.transform_pixbuf(self.get_pixbuf(), width, height,
+                                     self.rotation, self.flip_h, self.flip_v)
+
+    # (not cached per instance as the size of the files, it changes with
+    # the contents of the directory)
+    def get_original_size(self):
+        pixbuf = self.get_pixbuf()
+        return pixbuf.get_width(), pixbuf.get_height()
+
     @cached(cache, key_func=lambda self: ("items_count", self.directory))
     def get_items_count(self):
         scanner = FileScanner()
@@ -51,7 +76,7 @@ class DirectoryThumbnail(ImageFile):
 
         width, height = imagefile.get_dimensions_to_fit(size * dir_width, 
                                                         size * dir_height)
-        pixbuf = imagefile.get_pixbuf_at_size(width, height)
+        pixbuf = imagefile.get_thumbnail_at_size(width, height)
 
         offset_x = int((ret.get_width() - pixbuf.get_width()) / 2)
         offset_y = int((ret.get_height() * dir_offset) - (pixbuf.get_height()/2)) 
@@ -6,25 +6,24 @@ import string
 import tempfile
 
 import datetime
-import pexpect
 
 from imagefile import ImageFile
-from cache import Cache, cached
-from system import execute
-from utils import locked
-
-from threading import Lock
+from cache import cached
+from metacache import persistent
+from system import execute, stream
+from cancellation import Cancelled
+from threads import Lane
 
 class VideoFile(ImageFile):
     description = "video"
     valid_extensions = ["avi","mp4","flv","wmv","mpg","mov","m4v","webm", "3gp"]
-    video_cache = Cache(10)
-
-    def __init__(self, filename):
-        ImageFile.__init__(self, filename)
-        self.lock = Lock()
+    # The frames are extracted by avconv:
+    lane = Lane.IO
+    # Maximum time (in seconds) to extract a frame:
+    FRAME_TIMEOUT = 60
 
     @cached()
+    @persistent
     def get_metadata(self):
         info = [("Property", "Value")]
         output = execute(["avconv", "-i", self.get_filename()], check_retcode=False)
@@ -54,8 +53,7 @@ class VideoFile(ImageFile):
 
         return 0
 
-    @locked(lambda self: self.lock)
-    @cached(video_cache)
+    @cached(ImageFile.pixbuf_cache)
     def get_pixbuf(self):
         second_cap = int(round(self.get_duration() * 0.2))
         tmp_root = os.path.join(tempfile.gettempdir(), "%s" % self.get_basename())
@@ -63,6 +61,11 @@ class VideoFile(ImageFile):
 
         try:
             self.extract_frame_at(second_cap, tmp_img)
+        except Cancelled:
+            # (the process was killed, maybe after creating the file)
+            if os.path.isfile(tmp_img):
+                os.unlink(tmp_img)
+            raise
         except:
             print "Warning: unable to extract thumbnail from '%s'" % self.get_basename()
             return self.get_empty_pixbuf()
@@ -80,7 +83,7 @@ class VideoFile(ImageFile):
                  "-i", self.get_filename(), 
                  "-vframes", "1",
                  "-an",
-                 output])
+                 output], timeout=self.FRAME_TIMEOUT)
 
     def get_sha1(self):
         # avoiding this for video files
@@ -96,23 +99,16 @@ class VideoFile(ImageFile):
         try:
             if not count:
                 count = (self.get_duration()-offset) * rate
-            child = pexpect.spawn("avconv", ["-ss", str(offset), 
-                                             "-i", self.get_filename(), 
-                                             "-r", str(rate), 
-                                             "-qscale", "1", 
-                                             "-vframes", str(count),
-                                             pattern])
-            first = True
-            while True:
-                child.expect("frame=")
-                if not first:
-                    tokens = filter(lambda x:x, child.before.split(" "))
-                    frame = str(tokens[0])
+            for line in stream(["avconv", "-ss", str(offset), 
+                                "-i", self.get_filename(), 
+                                "-r", str(rate), 
+                                "-qscale", "1", 
+                                "-vframes", str(count),
+                                pattern]):
+                # Progress lines: "frame=  123 fps=..."
+                if line.startswith("frame="):
+                    frame = line[len("frame="):].split()[0]
                     yield float(frame) / count
-                else:
-                    first = False
-        except pexpect.EOF:
-            pass
         except Exception, e:
             print "Warning:", e
 
@@ -6,14 +6,16 @@ import shutil
 import cgi
 
 import gtk
+import gobject
 
-from imagefile import Size, GTKIconImage
+from imagefile import Size, ImageFile, GTKIconImage
 from filemanager import Action, FileManager
 from gallery import GalleryViewer
 from chooser import (OpenDialog, BasedirSelectorDialog, TargetSelectorDialog, 
                      RenameDialog, DirectorySelectorDialog, OutputDialog)
 from dialogs import (InfoDialog, ErrorDialog, AboutDialog, TextEntryDialog, 
-                     QuestionDialog, ProgressBarDialog, TabbedInfoDialog)
+                     QuestionDialog, ProgressBarDialog, TabbedInfoDialog,
+                     CacheStatsDialog)
 from imageviewer import ImageViewer, ThumbnailViewer
 from thumbnail import DirectoryThumbnail
 from downloader import MultiDownloader
@@ -25,7 +27,8 @@ from pdffile import PDFGenerator
 from filescanner import FileFilter, FileScanner
 from system import get_process_memory_usage, execute
 
-from threads import Worker, Updater
+from threads import Worker, Updater, Priority
+from cache import get_stats
 
 class BlockedWidget:
     def __init__(self, widget, handler_id):
@@ -89,6 +92,7 @@ class AutoScrolledWindow:
                             gtk.gdk.POINTER_MOTION_HINT_MASK)
 
         viewport.modify_bg(gtk.STATE_NORMAL, gtk.gdk.color_parse(bg_color))
+        child.modify_bg(gtk.STATE_NORMAL, gtk.gdk.color_parse(bg_color))
 
     def get_widget(self):
         return self.scrolled
@@ -467,6 +471,21 @@ class ViewerApp:
     DEF_HEIGHT = 768
     TH_SIZE = 200
     BG_COLOR = "#000000"
+    # Files decoded ahead in the direction of travel, and the maximum 
+    # proportion of the image cache they may use:
+    PREFETCH_DEPTH = 4
+    PREFETCH_BUDGET = 0.25
+    # When moving faster (moves per second), cheap previews (decoded at
+    # most at PREVIEW_SIZE, and only kept in memory) are prefetched 
+    # instead, for the files that will be reached in the next 
+    # PREFETCH_SECONDS:
+    FAST_VELOCITY = 2.0
+    PREVIEW_SIZE = 1024
+    PREFETCH_SECONDS = 2.0
+    MAX_PREFETCH_DEPTH = 32
+    # Moves at FAST_VELOCITY or more are coalesced, the viewer is only 
+    # reloaded after SETTLE_DELAY milliseconds without moves:
+    SETTLE_DELAY = 150
 
     def __init__(self, files, start_file, base_dir=None):
         ### Data definition
@@ -585,17 +604,25 @@ class ViewerApp:
 
         # Window composition end
 
-        # Loaders pool:
-        self.pool = []
-        self.main_loader = Worker()
-        self.loader_left = Worker()
-        self.loader_right = Worker()
-        self.pool.append(self.main_loader)
-        self.pool.append(self.loader_left)
-        self.pool.append(self.loader_right)
-
-        for worker in self.pool:
-            worker.start()
+        # The images are decoded to fit in the largest monitor (see
+        # ImageFile.screen_size):
+        screen = self.window.get_screen()
+        monitors = [screen.get_monitor_geometry(monitor)
+                    for monitor in range(screen.get_n_monitors())]
+        ImageFile.screen_size = (max(monitor.width for monitor in monitors),
+                                 max(monitor.height for monitor in monitors))
+
+        # Loaders (their jobs run in the shared thread pool):
+        self.main_loader = Worker(Priority.CURRENT)
+        self.loader_left = Worker(Priority.NEIGHBOURS)
+        self.loader_right = Worker(Priority.NEIGHBOURS)
+        self.prefetcher = Worker(Priority.PREFETCH)
+        self.loaders = [self.main_loader, self.loader_left, self.loader_right,
+                        self.prefetcher]
+        # Incremented on each move, so outdated prefetch jobs stop:
+        self.prefetch_serial = 0
+        # Pending reload of the viewer (see on_list_modified):
+        self.reload_source = None
 
         # Initial set of files:
         self.set_files(files, start_file)
@@ -856,6 +883,8 @@ class ViewerApp:
                  "items" : [{"text" : "See commands reference",
                              "accel" : (gtk.keysyms.question, 0),
                              "handler" : self.on_show_commands_reference},
+                            {"text" : "Cache statistics",
+                             "handler" : self.on_show_cache_stats},
                             {"separator" : True},
                             {"stock" : gtk.STOCK_ABOUT,
                              "handler" : self.on_show_about}]}]
@@ -1185,7 +1214,7 @@ class ViewerApp:
 
     ## Gtk event handlers
     def on_destroy(self, widget):
-        for worker in self.pool:
+        for worker in self.loaders:
             worker.stop()
             worker.join()
         gtk.main_quit()
@@ -1272,7 +1301,27 @@ class ViewerApp:
         self.undo_stack.push(self.file_manager.rename_current(new_name))
 
     def on_list_modified(self):
+        if self.reload_source:
+            gobject.source_remove(self.reload_source)
+            self.reload_source = None
+
+        if self.file_manager.get_velocity() < self.FAST_VELOCITY:
+            self.reload_viewer()
+            return
+
+        # Moving fast (key repeat, scrolling): only the index and a 
+        # preview (if it's already in memory) are shown, the viewer is
+        # reloaded when the moves stop:
+        self.refresh_index()
+        self.show_preview()
+        self.prefetch()
+        self.reload_source = gobject.timeout_add(self.SETTLE_DELAY,
+                                                 self.on_moves_settled)
+
+    def on_moves_settled(self):
+        self.reload_source = None
         self.reload_viewer()
+        return False
 
     def on_undo_stack_push(self, item):
         self.widget_manager.get("undo_mitem").set_sensitive(True)
@@ -1318,6 +1367,11 @@ class ViewerApp:
         current_file = self.file_manager.get_current_file()
         current_file.set_anim_enabled(False)
 
+        # Keep the decoded images of the visible files in memory:
+        ImageFile.pin_files([current_file,
+                             self.file_manager.get_prev_file(),
+                             self.file_manager.get_next_file()])
+
         # Handle star toggle
         with self.widget_manager.get_blocked("star_toggle") as star_toggle:
             star_toggle.set_active(current_file.is_starred()) 
@@ -1328,18 +1382,26 @@ class ViewerApp:
         # Update main viewer and thumbnails
         missing_image = GTKIconImage(gtk.STOCK_MISSING_IMAGE, 128)
         self.image_viewer.load(current_file)
-        self.fit_viewer(force=True) # Force immediate (and scaled) redraw
+        # Images not decoded yet are shown from their embedded preview,
+        # and decoded in the background:
+        if not self.show_embedded_preview(current_file):
+            self.main_loader.discard("main decode")
+            self.fit_viewer(force=True) # Force immediate (and scaled) redraw
         self.th_left.load(missing_image)
         self.th_right.load(missing_image)
-        self.loader_left.clear()
+        # (a pending job for the same widget is replaced)
+        prev_file = self.file_manager.get_prev_file()
+        next_file = self.file_manager.get_next_file()
         self.loader_left.push((self.prepare_thumbnail, 
-                              (self.th_left, self.file_manager.get_prev_file())))
-        self.loader_right.clear()
+                              (self.th_left, prev_file)),
+                              key="left thumbnail", lane=prev_file.lane)
         self.loader_right.push((self.prepare_thumbnail, 
-                               (self.th_right, self.file_manager.get_next_file())))
-        self.main_loader.clear()
+                               (self.th_right, next_file)),
+                               key="right thumbnail", lane=next_file.lane)
         self.main_loader.push((self.preload_main_viewer, 
-                               (self.image_viewer, current_file)))
+                               (self.image_viewer, current_file)),
+                              key="main viewer", lane=current_file.lane)
+        self.prefetch()
 
         # Handle extract buttons
         self.widget_manager.get("extract_mitem").set_sensitive(current_file.can_be_extracted())
@@ -1358,6 +1420,51 @@ class ViewerApp:
 
         self.refresh_info()
 
+    def show_preview(self):
+        current_file = self.file_manager.get_current_file()
+        # (the dimensions are needed, but not worth reading them now)
+        if current_file.get_original_size.peek(current_file) is None:
+            return
+
+        width, height = self.image_viewer.get_size()
+        preview = current_file.peek_quick_pixbuf_at_size(
+            *self.image_viewer.get_size_to_fit(current_file,
+                                               min(width, self.PREVIEW_SIZE),
+                                               min(height, self.PREVIEW_SIZE)))
+        if preview:
+            width, height = self.image_viewer.get_size_to_fit(current_file,
+                                                              width, height)
+            self.image_viewer.draw_pixbuf(
+                preview.scale_simple(width, height, gtk.gdk.INTERP_NEAREST))
+
+    def show_embedded_preview(self, file_):
+        allocation = self.scrolled.get_widget().allocation
+        width, height = allocation.width, allocation.height
+        self.image_viewer.force_zoom(width, height)
+        self.image_viewer.set_size(width, height)
+
+        size = self.image_viewer.get_scaled_size()
+        if file_.has_pixbuf_at_size(*size):
+            return False
+
+        preview = file_.get_preview_at_size(*size)
+        if not preview:
+            return False
+
+        self.image_viewer.draw_pixbuf(preview)
+        self.main_loader.push((self.decode_main_viewer, (file_, size)),
+                              key="main decode", lane=file_.lane)
+        return True
+
+    def decode_main_viewer(self, file_, size):
+        file_.get_pixbuf_at_size(*size)
+        return (self.on_main_viewer_decoded, (file_,))
+
+    def on_main_viewer_decoded(self, file_):
+        # (unless the user moved to another file meanwhile)
+        if file_ is self.file_manager.get_current_file():
+            self.fit_viewer(force=True)
+
     # This function will load the animated GIF in a separate thread:
     def preload_main_viewer(self, viewer, file_):
         anim_enabled = self.widget_manager.get("animation_toggle").get_active()
@@ -1379,9 +1486,77 @@ class ViewerApp:
     def load_main_viewer(self, viewer, file_):
         self.fit_viewer(force=True)
 
+    def prefetch(self):
+        # The running prefetch job isn't cancelled (the image it's 
+        # decoding is probably still ahead), it just stops after it:
+        self.prefetch_serial += 1
+
+        velocity = self.file_manager.get_velocity()
+        if velocity < self.FAST_VELOCITY:
+            depth, preview = self.PREFETCH_DEPTH, False
+        else:
+            depth = min(int(velocity * self.PREFETCH_SECONDS) + 1,
+                        self.MAX_PREFETCH_DEPTH)
+            preview = True
+
+        files = self.file_manager.get_files_ahead(depth)
+        if not files:
+            return
+
+        max_bytes = ImageFile.pixbuf_cache.max_bytes
+        if max_bytes is None:
+            budget = float("inf")
+        else:
+            budget = max_bytes * self.PREFETCH_BUDGET
+
+        width, height = self.image_viewer.get_size()
+        if preview:
+            width = min(width, self.PREVIEW_SIZE)
+            height = min(height, self.PREVIEW_SIZE)
+
+        self.push_prefetch(self.prefetch_serial, files, budget, preview,
+                           width, height)
+
+    # Each file is prefetched by its own job, in the lane of the file
+    # (the job of the next file is pushed when it ends):
+    def push_prefetch(self, serial, files, budget, preview, width, height):
+        self.prefetcher.push((self.prefetch_file,
+                              (serial, files, budget, preview, width, height)),
+                             lane=files[0].lane)
+
+    # Decodes and renders the first file to fit the viewer (as it would
+    # be drawn), or just its preview, if it fits in the budget:
+    def prefetch_file(self, serial, files, budget, preview, width, height):
+        if serial != self.prefetch_serial:
+            return (None, None)
+
+        file_ = files[0]
+        size = self.image_viewer.get_size_to_fit(file_, width, height)
+        if preview:
+            budget -= size[0] * size[1] * 4
+        else:
+            # (the image is decoded to fit in the screen)
+            decoded_size = self.image_viewer.get_size_to_fit(
+                               file_, *ImageFile.screen_size)
+            budget -= decoded_size[0] * decoded_size[1] * 4
+        if budget < 0:
+            return (None, None)
+
+        if preview:
+            file_.get_quick_pixbuf_at_size(*size)
+        else:
+            file_.get_pixbuf_at_size(*size)
+
+        if len(files) > 1:
+            self.push_prefetch(serial, files[1:], budget, preview,
+                               width, height)
+        return (None, None)
+
     # This function will preload the thumbnail in a separate thread:
     def prepare_thumbnail(self, thumb, file_):
-        file_.get_pixbuf() # it will be obtained and cached
+        # it will be obtained and cached:
+        file_.get_thumbnail_at_size(*file_.get_dimensions_to_fit(thumb.th_size,
+                                                                 thumb.th_size))
         return (thumb.load, (file_,))
 
     def fit_viewer(self, force=False):
@@ -1438,6 +1613,11 @@ class ViewerApp:
             span += ">%s</span>" % last_action.description
             file_info += "\n<i>Last action:</i> " + span
 
+        self.file_info.set_markup(file_info)
+        self.refresh_index()
+
+    def refresh_index(self):
+        image_file = self.file_manager.get_current_file()
         scanner = FileScanner()
         files = scanner.get_files_from_dir(image_file.get_dirname())
 
@@ -1452,7 +1632,6 @@ class ViewerApp:
         rss, vsize = get_process_memory_usage()
         file_index += "\n<i>RSS:</i> %s\n<i>VSize:</i> %s" % (Size(rss), Size(vsize))
 
-        self.file_info.set_markup(file_info)
         self.file_index.set_markup(file_index)
         self.file_index.set_justify(gtk.JUSTIFY_RIGHT)
 
@@ -1501,7 +1680,7 @@ class ViewerApp:
 
     def execute_viewer(self, args):
         main_py = os.path.join(os.path.dirname(__file__), "main.py")
-        execute([sys.executable, main_py] + args)
+        execute([sys.executable, main_py] + args, bounded=False)
 
     def quit_app(self):
         gtk.Widget.destroy(self.window)
@@ -1542,6 +1721,10 @@ class ViewerApp:
         dialog = TabbedInfoDialog(self.window, info)
         dialog.show()
 
+    def on_show_cache_stats(self, _):
+        dialog = CacheStatsDialog(self.window, get_stats)
+        dialog.show()
+
     def on_toggle_fullscreen(self, toggle):
         if toggle.get_active():
             self.window.fullscreen()
@@ -1781,7 +1964,7 @@ class ViewerApp:
 
     def on_open_in_nautilus(self, widget):
         current_file = self.file_manager.get_current_file()
-        execute(["nautilus", current_file.get_filename()])
+        execute(["nautilus", current_file.get_filename()], bounded=False)
 
     def on_sort_by_date(self, widget):
         self.files_order = "Date"